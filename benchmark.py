@@ -0,0 +1,184 @@
+"""Latency benchmarks of chart and mood log routes against a large synthetic dataset
+
+Seeds benchdb with seed.load_synthetic, drives routes with the Flask test client and
+reports p50/p95/p99 latency, SQL queries and bytes per response for each route, of
+the fastest of a few repeats.
+Results are compared with benchmark_baseline.json, regressions and routes missing
+from the baseline make it exit with 1.
+
+    python benchmark.py                     # seed, run and compare with baseline
+    python benchmark.py --no-seed           # reuse data already in benchdb, only GET routes
+    python benchmark.py --update-baseline   # store results as the new baseline
+"""
+
+from server import app
+from model import connect_to_db, db, Contract, Day
+from seed import load_drugs, load_synthetic
+from datetime import timedelta
+import numpy as np
+import argparse
+import json
+import sys
+import timeit
+
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# Relative increase over baseline latency/bytes reported as regression
+TOLERANCE = 0.25
+
+# Latency increase always allowed, runs of fast routes differ by a few ms
+LATENCY_SLACK_MS = 5
+
+
+def get_bench_users():
+    """Picks a client with many day logs and their pro to chart, and another client to log moods as"""
+
+    (client_id, pro_id), (writer_id, _) = db.session.query(Contract.client_id, Contract.pro_id)\
+                                                    .filter(Contract.active == True)\
+                                                    .order_by(Contract.client_id.desc())\
+                                                    .limit(2)\
+                                                    .all()
+    last_date = db.session.query(db.func.max(Day.date)).filter(Day.user_id == client_id).scalar()
+
+    return client_id, pro_id, writer_id, last_date
+
+
+def get_routes(client_id, pro_id, writer_id, last_date):
+    """Gives (name, user_id, method, url, params) of each route to benchmark
+
+    Moods are logged as writer_id, so charts of client_id are the same every run.
+    """
+
+    def date_str(days_before):
+        return (last_date - timedelta(days=days_before)).isoformat()
+
+    return [('mood_chart_month', client_id, 'GET', '/mood_chart.json',
+             {'minDate': date_str(30), 'maxDate': date_str(0), 'format': 'columnar'}),
+            ('mood_chart_year', client_id, 'GET', '/mood_chart.json',
+             {'minDate': date_str(365), 'maxDate': date_str(0)}),
+            ('mood_chart_all', client_id, 'GET', '/mood_chart.json',
+             {'minDate': date_str(5000), 'maxDate': date_str(0), 'format': 'columnar'}),
+            ('client_log_overview', pro_id, 'GET', '/client_log_overview.json',
+             {'clientId': client_id}),
+            ('day_chart', client_id, 'GET', '/day_chart.json',
+             {'day': date_str(3)}),
+            ('logs_html', client_id, 'GET', '/logs_html.json',
+             {'searchDate': date_str(3)}),
+            ('log_day_mood', writer_id, 'POST', '/log_day_mood',
+             {'today-date': date_str(2), 'overall-mood': 5, 'notes': 'benchmark'}),
+            ('log_event_mood', writer_id, 'POST', '/log_event_mood',
+             {'event-name': 'benchmark', 'today-event-date': date_str(2), 'overall-mood': 5})]
+
+
+def run_route(client, user_id, method, url, params, iterations):
+    """Sends a request to a route iterations times, gives latencies (ms), queries and bytes"""
+
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+
+    latencies = []
+    queries = []
+    sizes = []
+    for i in range(iterations):
+        start = timeit.default_timer()
+        if method == 'GET':
+            response = client.get(url, query_string=params)
+        else:
+            response = client.post(url, data=params)
+        latencies.append((timeit.default_timer() - start) * 1000)
+        # counted by instrumentation.py
+        queries.append(int(response.headers['X-DB-Queries']))
+        sizes.append(len(response.data))
+
+    return {'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'p99': float(np.percentile(latencies, 99)),
+            'queries': max(queries),
+            'bytes': max(sizes)}
+
+
+def find_regressions(results, baseline):
+    """Gives list of messages for results worse than baseline"""
+
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            # an unmeasured route would never regress
+            regressions.append('%s: no baseline, record one on the reference machine with --update-baseline'
+                               % name)
+            continue
+        if result['p95'] > max(base['p95'] * (1 + TOLERANCE), base['p95'] + LATENCY_SLACK_MS):
+            regressions.append('%s: p95 %.1fms, baseline %.1fms' % (name, result['p95'], base['p95']))
+        if result['queries'] > base['queries']:
+            regressions.append('%s: %s queries, baseline %s' % (name, result['queries'], base['queries']))
+        if result['bytes'] > base['bytes'] * (1 + TOLERANCE):
+            regressions.append('%s: %s bytes, baseline %s' % (name, result['bytes'], base['bytes']))
+
+    return regressions
+
+
+def print_results(results, baseline):
+    """Prints a table of results next to baseline p95"""
+
+    print '%-22s %9s %9s %9s %8s %10s %12s' % ('route', 'p50 ms', 'p95 ms', 'p99 ms',
+                                               'queries', 'bytes', 'base p95 ms')
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        print '%-22s %9.1f %9.1f %9.1f %8s %10s %12s' % (name, result['p50'], result['p95'], result['p99'],
+                                                        result['queries'], result['bytes'],
+                                                        '%.1f' % base['p95'] if base else '-')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark chart and mood log routes')
+    parser.add_argument('--no-seed', action='store_true', help='use data already in database')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--years', type=float, default=5)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3, help='times every route is run, the fastest is kept')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--db', default='benchdb')
+    args = parser.parse_args()
+
+    app.config['TESTING'] = True
+    # every request makes its chart, as the routes' own latency is measured
+    app.config['CHART_CACHE'] = False
+    connect_to_db(app, args.db)
+
+    if not args.no_seed:
+        db.drop_all()
+        db.create_all()
+        load_drugs()
+        load_synthetic(num_users=args.users, num_pros=max(args.users / 20, 1), years=args.years)
+
+    client = app.test_client()
+    client_id, pro_id, writer_id, last_date = get_bench_users()
+
+    results = {}
+    for i in range(args.repeat):
+        for name, user_id, method, url, params in get_routes(client_id, pro_id, writer_id, last_date):
+            # each run logs more moods of writer_id, so they're only timed against freshly seeded data
+            if method == 'POST' and args.no_seed:
+                continue
+            # warm up caches and connections before measuring
+            run_route(client, user_id, method, url, params, 2)
+            result = run_route(client, user_id, method, url, params, args.iterations)
+            # as with timeit, the fastest repeat is the one least slowed by other processes
+            if name not in results or result['p95'] < results[name]['p95']:
+                results[name] = result
+
+    with open(BASELINE_FILE) as baseline_file:
+        baseline = json.load(baseline_file)['routes']
+
+    print_results(results, baseline)
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump({'routes': results}, baseline_file, indent=4, sort_keys=True)
+        print 'Baseline updated'
+    else:
+        regressions = find_regressions(results, baseline)
+        for regression in regressions:
+            print 'REGRESSION %s' % regression
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,115 @@
+"""Caches shared by the requests of a worker"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread safe dict of values that expire after a number of seconds
+
+    Past max_size entries, the ones set longest ago are evicted first.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Returns value of key, None if it isn't cached or has expired"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class LRUCache(object):
+    """Thread safe dict of strings taking at most max_bytes, least recently used evicted first
+
+    Entries can be tagged, e.g. with the user they're about, to be deleted together.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.size = 0
+
+    def get(self, key, tag=None):
+        """Returns value of key, None if it isn't cached"""
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, tag=None):
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, tag)
+            self.tags.setdefault(tag, set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """Removes key, lock must be held"""
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            value, tag = entry
+            self.size -= len(key) + len(value)
+            keys = self.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def delete_tag(self, tag):
+        """Deletes every entry set with tag"""
+
+        with self.lock:
+            for key in list(self.tags.get(tag, ())):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
@@ -1,27 +1,235 @@
+"""Daily email reminders for users who haven't logged their mood today
+
+Run by cron (see cron-startup.sh). Users are read in batches from one query,
+messages are sent by a pool of workers each reusing one SMTP connection.
+
+To try it against a local stand-in SMTP server:
+    python -m smtpd -n -c DebuggingServer localhost:1025
+    MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS=0 python cron_mail.py
+"""
+
 from server import app
+from model import connect_to_db, db
+from metrics import Registry, Gauge, write_textfile
 from flask_mail import Mail, Message
+from jinja2 import Template
+from sqlalchemy import text
+from datetime import datetime
+from pytz import timezone
+from Queue import Queue
+import argparse
+import smtplib
+import socket
+import threading
+import time
 import os
 
 sender_email = os.environ.get('FLASK_MAIL_SENDER_EMAIL')
 sender_password = os.environ.get('FLASK_MAIL_SENDER_PASSWORD')
 
 app.config.update(dict(
-    MAIL_SERVER='smtp.gmail.com',
-    MAIL_PORT=587,
-    MAIL_USE_TLS=True,
+    MAIL_SERVER=os.environ.get('MAIL_SERVER', 'smtp.gmail.com'),
+    MAIL_PORT=int(os.environ.get('MAIL_PORT', 587)),
+    MAIL_USE_TLS=os.environ.get('MAIL_USE_TLS', '1') == '1',
     MAIL_USERNAME=sender_email,
     MAIL_PASSWORD=sender_password))
 
 mail = Mail(app)
 
-with app.app_context():
-        # keeps connection to email host alive until messages are all sent
-        # good for external processes like command-line scripts or cronjobs
-        with mail.connect() as conn:
+# Throughput of last run, appended to the app's /metrics
+METRICS_FILE = os.environ.get('MOODWATCH_REMINDER_METRICS',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reminder_metrics.prom'))
+
+# Timezone days are logged in
+REMINDER_TZ = 'US/Pacific'
+
+# Users with no day log rated today. Anti-join on the user_date index
+INACTIVE_USERS_SQL = text("""
+    SELECT users.user_id, users.username, users.email
+    FROM users
+    WHERE NOT EXISTS (SELECT 1
+                      FROM days
+                      WHERE days.user_id = users.user_id
+                        AND days.date = :today
+                        AND days.overall_mood IS NOT NULL)
+    ORDER BY users.user_id
+""")
+
+REMINDER_SUBJECT = 'How are you doing today?'
+
+# Compiled once, rendered for each user
+REMINDER_BODY = Template("""Hi {{ username }},
+
+You haven't logged your mood for {{ today }} yet.
+Take a minute to rate your day at MoodWatch, it helps you see how you're doing over time.
+
+- MoodWatch
+""")
+
+# Errors from the SMTP server or connection
+SMTP_ERRORS = (smtplib.SMTPException, socket.error)
+
+# Lost connections, the rest of the batch is retried on a new connection
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+# Refusals of one message, e.g. of a bad address, it fails and the rest are still sent
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+def get_inactive_users(today, batch_size):
+    """Yields batches of (user_id, username, email) of users who haven't logged today
+
+    Reads from a server-side cursor so all users are never in memory at once.
+    """
+
+    result = db.session.connection(execution_options={'stream_results': True})\
+                       .execute(INACTIVE_USERS_SQL, today=today)
+    while True:
+        users = result.fetchmany(batch_size)
+        if not users:
+            break
+        yield users
+
+
+def make_reminders(users, today):
+    """Renders reminder messages for a batch of users"""
+
+    today_str = today.strftime('%A, %B %d')
+    return [Message(REMINDER_SUBJECT,
+                    sender=sender_email,
+                    recipients=[email],
+                    body=REMINDER_BODY.render(username=username, today=today_str))
+            for user_id, username, email in users]
+
+
+class ReminderSender(object):
+    """Pool of workers sending batches of messages, each over its own SMTP connection"""
+
+    def __init__(self, num_workers, max_retries=3, retry_wait=2):
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        # bounded, so reading users waits on sending
+        self.batches = Queue(maxsize=num_workers * 2)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.workers = [threading.Thread(target=self.work) for i in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def send(self, messages):
+        """Queues a batch of messages to be sent"""
+
+        self.batches.put(messages)
+
+    def close(self):
+        """Waits for every queued batch to be sent and stops workers"""
+
+        for worker in self.workers:
+            self.batches.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def work(self):
+        """Sends batches from queue until told to stop, reconnecting on errors"""
+
+        with app.app_context():
+            conn = None
+            while True:
+                messages = self.batches.get()
+                if messages is None:
+                    break
+
+                sent = 0
+                refused = 0
+                try:
+                    for attempt in range(self.max_retries + 1):
+                        try:
+                            if conn is None:
+                                conn = mail.connect().__enter__()
+                            # only messages not tried before the connection was lost are retried
+                            for message in messages[sent + refused:]:
+                                try:
+                                    conn.send(message)
+                                    sent += 1
+                                except MESSAGE_ERRORS as error:
+                                    app.logger.warning('Reminder to %s refused: %s', message.recipients, error)
+                                    refused += 1
+                            break
+                        except CONNECTION_ERRORS as error:
+                            app.logger.warning('Reminder batch failed (attempt %s): %s', attempt + 1, error)
+                            conn = self.disconnect(conn)
+                            time.sleep(self.retry_wait * (attempt + 1))
+                        except SMTP_ERRORS as error:
+                            # e.g. login refused, retrying wouldn't help
+                            app.logger.error('Reminder batch failed: %s', error)
+                            conn = self.disconnect(conn)
+                            break
+                except Exception:
+                    # anything else fails the batch, the worker goes on to the next one
+                    app.logger.exception('Reminder batch failed')
+                    conn = self.disconnect(conn)
+
+                with self.lock:
+                    self.sent += sent
+                    self.failed += len(messages) - sent
+
+            self.disconnect(conn)
+
+    def disconnect(self, conn):
+        """Closes SMTP connection, ignoring errors from one that's already broken, returns None"""
+
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except SMTP_ERRORS:
+                pass
+
+        return None
+
+
+def send_reminders(num_workers=8, batch_size=500):
+    """Sends reminders to every user who hasn't logged today, returns (sent, failed, seconds)"""
+
+    start = time.time()
+    today = datetime.now(timezone(REMINDER_TZ)).date()
+    sender = ReminderSender(num_workers)
+    try:
+        for users in get_inactive_users(today, batch_size):
+            sender.send(make_reminders(users, today))
+    finally:
+        sender.close()
+
+    return sender.sent, sender.failed, time.time() - start
+
+
+def write_metrics(sent, failed, seconds):
+    """Writes throughput of a run for /metrics to pick up"""
+
+    registry = Registry()
+    metrics = [(Gauge('moodwatch_reminders_sent', 'Reminders sent in last run', registry=registry), sent),
+               (Gauge('moodwatch_reminders_failed', 'Reminders that failed in last run', registry=registry), failed),
+               (Gauge('moodwatch_reminders_seconds', 'Duration of last run', registry=registry), seconds),
+               (Gauge('moodwatch_reminders_per_second', 'Reminders sent per second in last run',
+                      registry=registry), sent / max(seconds, 0.001)),
+               (Gauge('moodwatch_reminders_last_run_timestamp', 'End of last run, unix time',
+                      registry=registry), time.time())]
+    for gauge, value in metrics:
+        gauge.set(value)
+    write_textfile(METRICS_FILE, registry)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Email reminders to users who have not logged today')
+    parser.add_argument('--workers', type=int, default=8, help='SMTP connections sending at once')
+    parser.add_argument('--batch-size', type=int, default=500, help='users read and rendered at a time')
+    args = parser.parse_args()
+
+    connect_to_db(app, 'asgard_db')
 
-            msg = Message('Testing mail',
-                          body='Hey Hey',
-                          sender=sender_email,
-                          recipients=['fake@email.com'])
+    with app.app_context():
+        sent, failed, seconds = send_reminders(args.workers, args.batch_size)
 
-            conn.send(msg)
+    write_metrics(sent, failed, seconds)
+    print "Sent %s reminders (%s failed) in %.1fs, %.1f/s" % (sent, failed, seconds, sent / max(seconds, 0.001))
@@ -0,0 +1,220 @@
+"""In-memory index of the drug catalog, for typeahead search
+
+Generic and brand names are kept in a sorted list for prefix search (bisect)
+and in a trigram index for fuzzy search, similar to pg_trgm. The index is
+rebuilt on the next lookup after drugs are changed through the ORM in this
+process or another one telling it through invalidation.py, and when the drugs
+table's write statistics change, checked at most every CHECK_INTERVAL seconds.
+"""
+
+from model import db, Drug, INVALIDATION_CHANNEL
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session, object_session
+from bisect import bisect_left
+import math
+import re
+import threading
+import time
+
+# Seconds between checks of the drugs table for changes made outside this process
+CHECK_INTERVAL = 5
+
+# Least share of trigrams a name must have in common with a query to match it, as in pg_trgm
+SIMILARITY_THRESHOLD = 0.3
+
+# Queries whose matches are kept by an index
+MAX_CACHED_RESULTS = 1000
+
+NON_ALNUM = re.compile(r'[^a-z0-9]+')
+BRAND_SEPARATORS = re.compile(r'[,;/]')
+
+# Changes to drugs, including ones from other processes
+TABLE_SIGNATURE_SQL = text("""
+    SELECT n_tup_ins, n_tup_upd, n_tup_del
+    FROM pg_stat_user_tables
+    WHERE relname = 'drugs'
+""")
+
+
+def normalize(name):
+    """Lowercases a name and turns runs of punctuation and spaces into one space"""
+
+    return NON_ALNUM.sub(' ', name.lower()).strip()
+
+
+def trigrams(name):
+    """Gives set of trigrams of the words of a normalized name, padded like pg_trgm"""
+
+    grams = set()
+    for word in name.split():
+        padded = '  %s ' % word
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+class DrugIndex(object):
+    """Snapshot of the catalog, never changed once built so lookups need no lock
+
+    Only its cache of query results changes, which is safe to share between threads.
+    """
+
+    def __init__(self, drugs):
+        # drug_id to dict of drug info
+        self.drugs = {}
+        # sorted (name, drug_id) of every generic and brand name
+        names = set()
+        for drug_id, generic_name, brand_name, uses in drugs:
+            self.drugs[drug_id] = {'drug_id': drug_id,
+                                   'generic_name': generic_name,
+                                   'brand_name': brand_name,
+                                   'uses': uses}
+            names.add((normalize(generic_name), drug_id))
+            for brand in BRAND_SEPARATORS.split(brand_name or ''):
+                if normalize(brand):
+                    names.add((normalize(brand), drug_id))
+
+        self.names = sorted(names)
+        self.keys = [name for name, drug_id in self.names]
+        self.by_generic_name = sorted(self.drugs, key=lambda drug_id: normalize(self.drugs[drug_id]['generic_name']))
+
+        # trigram to positions in names
+        self.name_trigrams = [trigrams(name) for name in self.keys]
+        self.trigram_names = {}
+        for position, grams in enumerate(self.name_trigrams):
+            for gram in grams:
+                self.trigram_names.setdefault(gram, []).append(position)
+
+        # normalized query to its matches
+        self.results = {}
+
+    def prefix_matches(self, query):
+        """Gives drug_ids with a name starting with query, in order of name"""
+
+        start = bisect_left(self.keys, query)
+        end = bisect_left(self.keys, query + u'\uffff', start)
+
+        return [drug_id for name, drug_id in self.names[start:end]]
+
+    def fuzzy_matches(self, query):
+        """Gives drug_ids with a name similar to query, most similar first"""
+
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        # A similar name shares at least min_shared trigrams with query, so it has one of
+        # its rarest trigrams. Names only having the commonest ones are never counted.
+        postings = sorted((self.trigram_names.get(gram, []) for gram in query_grams), key=len)
+        min_shared = int(math.ceil(SIMILARITY_THRESHOLD * len(postings)))
+        num_searched = len(postings) - min_shared + 1
+        shared = {}
+        for positions in postings[:num_searched]:
+            for position in positions:
+                shared[position] = shared.get(position, 0) + 1
+        for positions in postings[num_searched:]:
+            for position in shared:
+                # positions are in increasing order
+                found = bisect_left(positions, position)
+                if found < len(positions) and positions[found] == position:
+                    shared[position] += 1
+
+        scores = {}
+        for position, count in shared.iteritems():
+            similarity = float(count) / (len(query_grams) + len(self.name_trigrams[position]) - count)
+            if similarity >= SIMILARITY_THRESHOLD:
+                drug_id = self.names[position][1]
+                scores[drug_id] = max(similarity, scores.get(drug_id, 0))
+
+        return sorted(scores, key=lambda drug_id: (-scores[drug_id], self.drugs[drug_id]['generic_name']))
+
+    def search(self, query):
+        """Gives drug_ids with a name starting with query, or similar names if there are none"""
+
+        query = normalize(query)
+        if not query:
+            return self.by_generic_name
+
+        matches = self.results.get(query)
+        if matches is None:
+            matches = []
+            seen = set()
+            for drug_id in self.prefix_matches(query) or self.fuzzy_matches(query):
+                if drug_id not in seen:
+                    seen.add(drug_id)
+                    matches.append(drug_id)
+            # pages of a query are asked for one after the other
+            if len(self.results) >= MAX_CACHED_RESULTS:
+                self.results.clear()
+            self.results[query] = matches
+
+        return matches
+
+
+class DrugCatalog(object):
+    """Drug index of this process, rebuilt when drugs change"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.signature = None
+        self.stale = True
+        self.checked = 0
+
+    def invalidate(self):
+        self.stale = True
+
+    def get_signature(self):
+        return tuple(db.session.execute(TABLE_SIGNATURE_SQL).first() or ())
+
+    def get_index(self):
+        """Gives current index, rebuilding it first if drugs have changed"""
+
+        if not self.stale and time.time() - self.checked > CHECK_INTERVAL:
+            self.checked = time.time()
+            if self.get_signature() != self.signature:
+                self.stale = True
+
+        if self.stale:
+            with self.lock:
+                if self.stale:
+                    signature = self.get_signature()
+                    drugs = db.session.query(Drug.drug_id, Drug.generic_name, Drug.brand_name, Drug.uses)
+                    self.index = DrugIndex(drugs)
+                    self.signature = signature
+                    self.checked = time.time()
+                    self.stale = False
+
+        return self.index
+
+    def search(self, query, offset=0, limit=20):
+        """Returns (list of drug dicts on the page, number of matches) of drugs matching query"""
+
+        index = self.get_index()
+        matches = index.search(query)
+
+        return [index.drugs[drug_id] for drug_id in matches[offset:offset + limit]], len(matches)
+
+
+catalog = DrugCatalog()
+
+
+# Tells other processes drugs changed, on commit
+NOTIFY_DRUGS_SQL = text("SELECT pg_notify(:channel, 'drugs')")
+
+
+def mark_drugs_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['drugs_changed'] = True
+    connection.execute(NOTIFY_DRUGS_SQL, channel=INVALIDATION_CHANNEL)
+
+
+def invalidate_after_commit(session):
+    if session.info.pop('drugs_changed', False):
+        catalog.invalidate()
+
+
+for change in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Drug, change, mark_drugs_changed)
+event.listen(Session, 'after_commit', invalidate_after_commit)
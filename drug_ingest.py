@@ -0,0 +1,177 @@
+"""Streaming bulk load of drug catalogs into the drugs table
+
+Reads drugs one record at a time from the pdftotext format of psych_meds.txt,
+CSV or NDJSON (one object per line) with generic_name, brand_name and uses,
+and upserts them in batches on generic name. Each batch is its own short
+transaction and only rows that changed are updated, so prescriptions can be
+written while a large catalog is refreshed. The last drug of a generic name
+in a file wins. Drugs missing from a file are kept, prescriptions may refer
+to them.
+
+    python drug_ingest.py psych_meds.txt
+    python drug_ingest.py fda_drugs.csv --batch-size 10000
+"""
+
+from model import connect_to_db, db, notify_invalidation
+from server import app
+from sqlalchemy import text
+import argparse
+import csv
+import json
+import timeit
+
+# Labels of the column blocks in pdftotext output
+TXT_LABELS = ('GENERIC', 'BRAND', 'USES')
+
+# Longest generic name the drugs table holds
+MAX_GENERIC_NAME = 128
+
+UPSERT_DRUGS_SQL = text("""
+    INSERT INTO drugs (generic_name, brand_name, uses)
+    SELECT *
+    FROM unnest(CAST(:generic_names AS TEXT[]), CAST(:brand_names AS TEXT[]), CAST(:uses AS TEXT[]))
+    ON CONFLICT (generic_name) DO UPDATE
+    SET brand_name = EXCLUDED.brand_name,
+        uses = EXCLUDED.uses
+    WHERE (drugs.brand_name, drugs.uses) IS DISTINCT FROM (EXCLUDED.brand_name, EXCLUDED.uses)
+    RETURNING xmax = 0 AS inserted
+""")
+
+
+def iter_txt_drugs(lines):
+    """Yields (generic_name, brand_name, uses) of pdftotext output of a medication fact sheet
+
+    Pages start with one line each of generic name, brand names and uses per drug,
+    then may list drugs as blocks of a column each, headed by GENERIC, BRAND and USES.
+    Only one set of column blocks is kept in memory at a time.
+    """
+
+    drug = []
+    columns = {}
+    label = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line in TXT_LABELS:
+            # a new set of blocks starts once the last one is complete
+            if line == TXT_LABELS[0] and columns.get(TXT_LABELS[-1]):
+                for drug_columns in zip(*[columns[name] for name in TXT_LABELS]):
+                    yield drug_columns
+                columns = {}
+            label = line
+        elif label:
+            columns.setdefault(label, []).append(line)
+        else:
+            drug.append(line)
+            if len(drug) == 3:
+                yield tuple(drug)
+                drug = []
+
+    if columns:
+        for drug_columns in zip(*[columns.get(name, []) for name in TXT_LABELS]):
+            yield drug_columns
+
+
+def iter_csv_drugs(lines):
+    """Yields (generic_name, brand_name, uses) of CSV rows with those columns"""
+
+    for row in csv.DictReader(lines):
+        yield row.get('generic_name'), row.get('brand_name'), row.get('uses')
+
+
+def iter_ndjson_drugs(lines):
+    """Yields (generic_name, brand_name, uses) of a JSON object on each line"""
+
+    for line in lines:
+        if line.strip():
+            drug = json.loads(line)
+            yield drug.get('generic_name'), drug.get('brand_name'), drug.get('uses')
+
+
+DRUG_READERS = {'txt': iter_txt_drugs,
+                'csv': iter_csv_drugs,
+                'ndjson': iter_ndjson_drugs,
+                'jsonl': iter_ndjson_drugs}
+
+
+def decode(value):
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+
+    return value.strip() if value else value
+
+
+def upsert_drugs(drugs):
+    """Inserts or updates a batch of drugs by generic name, returns (inserted, updated)
+
+    A generic name given more than once is loaded with its last drug, as it
+    would be were they in different batches.
+    """
+
+    # a statement can't update the same row twice
+    drugs = dict((drug[0], drug) for drug in drugs).values()
+    if not drugs:
+        return 0, 0
+
+    generic_names, brand_names, uses = zip(*drugs)
+    result = db.session.execute(UPSERT_DRUGS_SQL, {'generic_names': list(generic_names),
+                                                   'brand_names': list(brand_names),
+                                                   'uses': list(uses)})
+    changed = [inserted for inserted, in result]
+
+    return sum(changed), len(changed) - sum(changed)
+
+
+def ingest_drugs(path, file_format=None, batch_size=5000):
+    """Streams drugs of a file into the drugs table, a batch per transaction
+
+    Returns dict of counts of drugs read, inserted, updated and skipped (no generic name).
+    """
+
+    file_format = file_format or path.rsplit('.', 1)[-1].lower()
+    read_drugs = DRUG_READERS[file_format]
+    counts = {'read': 0, 'inserted': 0, 'updated': 0, 'skipped': 0}
+
+    def load(batch):
+        inserted, updated = upsert_drugs(batch)
+        if inserted or updated:
+            notify_invalidation('drugs')
+        db.session.commit()
+        counts['inserted'] += inserted
+        counts['updated'] += updated
+
+    with open(path) as drug_file:
+        batch = []
+        for generic_name, brand_name, uses in read_drugs(drug_file):
+            counts['read'] += 1
+            generic_name = decode(generic_name)
+            if not generic_name:
+                counts['skipped'] += 1
+                continue
+            batch.append((generic_name[:MAX_GENERIC_NAME], decode(brand_name) or '', decode(uses)))
+            if len(batch) >= batch_size:
+                load(batch)
+                batch = []
+        load(batch)
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load or refresh drugs from a catalog file')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=sorted(DRUG_READERS), help='defaults to file extension')
+    parser.add_argument('--batch-size', type=int, default=5000, help='drugs upserted per transaction')
+    parser.add_argument('--db', default='asgard_db')
+    args = parser.parse_args()
+
+    connect_to_db(app, args.db)
+
+    start = timeit.default_timer()
+    with app.app_context():
+        counts = ingest_drugs(args.path, args.format, args.batch_size)
+
+    print "Read %(read)s drugs: %(inserted)s inserted, %(updated)s updated, %(skipped)s skipped" % counts
+    print "Took %.1fs" % (timeit.default_timer() - start)
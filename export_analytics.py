@@ -0,0 +1,272 @@
+"""Columnar export of all mood data for analytics, as Parquet or Arrow IPC files
+
+Scans days, events, event_days and prescriptions in chunks from server-side
+cursors and writes them partitioned by month:
+
+    <out>/<table>/month=YYYY-MM/part-<first change>-<last change>.parquet
+
+Every run reads one snapshot of the database. Runs are incremental: only rows
+written since the last run (by their change_seq, kept in <out>/export_state.json)
+are exported, so a row updated since appears again in a later part with a
+higher change_seq. A run exports up to the last change_seq drawn when it starts,
+after waiting for transactions open then to end, so rows still being written
+aren't skipped (transactions are seen in pg_stat_activity, so run it as the
+app's database user). If they don't end in time, it exports up to where the
+last run did. Free text notes are left out.
+
+A full export replaces the files of every table in <out>.
+
+Needs pyarrow (pip install pyarrow), which the app itself doesn't.
+
+    python export_analytics.py --out analytics           # rows changed since last run
+    python export_analytics.py --out analytics --full    # everything
+"""
+
+from model import connect_to_db, db
+from server import app
+from sqlalchemy import text
+from itertools import groupby
+import argparse
+import json
+import os
+import shutil
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+STATE_FILE = 'export_state.json'
+
+# Last change_seq drawn, 0 if none has been, and when it was read
+WATERMARK_SQL = """
+    SELECT CASE WHEN is_called THEN last_value ELSE 0 END, clock_timestamp()
+    FROM log_change_seq
+"""
+
+# Start of the oldest transaction of a client open in the database, other than this one.
+# Background workers (autovacuum, replication) don't draw change_seqs.
+OLDEST_TRANSACTION_SQL = """
+    SELECT MIN(xact_start)
+    FROM pg_stat_activity
+    WHERE datname = current_database()
+      AND backend_type = 'client backend'
+      AND pid <> pg_backend_pid()
+"""
+
+# Each query gives the table's columns, then the date its row is partitioned by.
+# Rows come in order of partition, so one file is open at a time.
+EXPORT_TABLES = [
+    ('days', """
+        SELECT day_id, user_id, date, overall_mood, max_mood, min_mood, change_seq,
+               date AS partition_date
+        FROM days
+        WHERE change_seq > :since AND change_seq <= :until
+        ORDER BY partition_date
+     """),
+    ('events', """
+        SELECT events.event_id, events.user_id, events.event_name, events.overall_mood,
+               events.max_mood, events.min_mood, events.change_seq, event_range.start_date,
+               event_range.start_date AS partition_date
+        FROM events
+        LEFT JOIN LATERAL (SELECT MIN(days.date) AS start_date
+                           FROM event_days
+                           JOIN days ON days.day_id = event_days.day_id
+                           WHERE event_days.event_id = events.event_id) AS event_range ON true
+        WHERE events.change_seq > :since AND events.change_seq <= :until
+        ORDER BY partition_date
+     """),
+    # rows are only added along with their event
+    ('event_days', """
+        SELECT event_days.event_days_id, event_days.event_id, event_days.day_id, days.date,
+               events.change_seq, days.date AS partition_date
+        FROM event_days
+        JOIN events ON events.event_id = event_days.event_id
+        JOIN days ON days.day_id = event_days.day_id
+        WHERE events.change_seq > :since AND events.change_seq <= :until
+        ORDER BY partition_date
+     """),
+    ('prescriptions', """
+        SELECT prescription_id, client_id, pro_id, drug_id, start_date, end_date, change_seq,
+               start_date AS partition_date
+        FROM prescriptions
+        WHERE change_seq > :since AND change_seq <= :until
+        ORDER BY partition_date
+     """),
+]
+
+
+def make_schemas():
+    """Gives arrow schema of each exported table"""
+
+    def fields(*columns):
+        return pa.schema([pa.field(name, column_type) for name, column_type in columns])
+
+    integer, date = pa.int32(), pa.date32()
+    moods = [('overall_mood', integer), ('max_mood', integer), ('min_mood', integer)]
+    return {'days': fields(*[('day_id', integer), ('user_id', integer), ('date', date)] + moods +
+                            [('change_seq', pa.int64())]),
+            'events': fields(*[('event_id', integer), ('user_id', integer), ('event_name', pa.string())] + moods +
+                              [('change_seq', pa.int64()), ('start_date', date)]),
+            'event_days': fields(('event_days_id', integer), ('event_id', integer), ('day_id', integer),
+                                 ('date', date), ('change_seq', pa.int64())),
+            'prescriptions': fields(('prescription_id', integer), ('client_id', integer), ('pro_id', integer),
+                                    ('drug_id', integer), ('start_date', date), ('end_date', date),
+                                    ('change_seq', pa.int64()))}
+
+
+class PartitionWriter(object):
+    """Writes rows of a table, in order of partition, to a Parquet or Arrow file per month"""
+
+    def __init__(self, out_dir, table, schema, file_format, part_name):
+        self.out_dir = out_dir
+        self.table = table
+        self.schema = schema
+        self.file_format = file_format
+        self.part_name = part_name
+        self.month = None
+        self.writer = None
+        self.rows = 0
+
+    def open(self, month):
+        self.close()
+        partition_dir = os.path.join(self.out_dir, self.table, 'month=%s' % month)
+        if not os.path.isdir(partition_dir):
+            os.makedirs(partition_dir)
+        path = os.path.join(partition_dir, '%s.%s' % (self.part_name, self.file_format))
+        if self.file_format == 'parquet':
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.RecordBatchFileWriter(path, self.schema)
+        self.month = month
+
+    def write(self, rows):
+        """Writes a chunk of rows (columns of the schema, then partition date) as columnar batches"""
+
+        for month, month_rows in groupby(rows, lambda row: row[-1].strftime('%Y-%m') if row[-1] else 'unknown'):
+            if month != self.month:
+                self.open(month)
+            columns = zip(*[tuple(row)[:-1] for row in month_rows])
+            batch = pa.RecordBatch.from_arrays([pa.array(list(column), type=field.type)
+                                                for column, field in zip(columns, self.schema)],
+                                               schema=self.schema)
+            if self.file_format == 'parquet':
+                self.writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                self.writer.write_batch(batch)
+            self.rows += batch.num_rows
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def read_state(out_dir):
+    """Gives change_seq exported up to by the last run, 0 if there was none"""
+
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return 0
+
+    with open(path) as state_file:
+        return json.load(state_file)['change_seq']
+
+
+def write_state(out_dir, change_seq):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump({'change_seq': change_seq}, state_file)
+    os.rename(path + '.tmp', path)
+
+
+def get_watermark(wait, last_safe):
+    """Gives last change_seq drawn once every transaction that could have drawn it has ended
+
+    Changes numbered up to it are then all committed or rolled back. If
+    transactions are still open after wait seconds, gives last_safe, a
+    watermark an earlier run found safe.
+    """
+
+    watermark, read_at = db.session.execute(WATERMARK_SQL).first()
+    db.session.commit()
+    deadline = time.time() + wait
+    while True:
+        oldest = db.session.execute(OLDEST_TRANSACTION_SQL).scalar()
+        # activity is read once per transaction
+        db.session.commit()
+        if oldest is None or oldest > read_at:
+            return watermark
+        if time.time() > deadline:
+            app.logger.warning('A transaction open since %s is still running, exporting up to change %s',
+                               oldest, last_safe)
+            return last_safe
+        time.sleep(1)
+
+
+def export_analytics(out_dir, file_format='parquet', full=False, chunk_size=50000, wait=60):
+    """Exports rows changed since the last run (or all rows) of every table, returns rows per table"""
+
+    if pa is None:
+        raise RuntimeError('pyarrow is needed to export analytics, pip install pyarrow')
+
+    last_safe = read_state(out_dir)
+    since = 0 if full else last_safe
+    until = get_watermark(wait, last_safe)
+    if until <= since:
+        return {}
+
+    if full:
+        # rows already exported would be written again, a run cut short starts over
+        write_state(out_dir, 0)
+        for table, query in EXPORT_TABLES:
+            shutil.rmtree(os.path.join(out_dir, table), ignore_errors=True)
+
+    # one snapshot for every table, taken after writes up to until ended, so
+    # rows of a run are consistent with each other
+    connection = db.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+
+    schemas = make_schemas()
+    exported = {}
+    for table, query in EXPORT_TABLES:
+        writer = PartitionWriter(out_dir, table, schemas[table], file_format,
+                                 'part-%s-%s' % (since + 1, until))
+        result = connection.execution_options(stream_results=True)\
+                           .execute(text(query), since=since, until=until)
+        try:
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                writer.write(rows)
+        finally:
+            writer.close()
+        exported[table] = writer.rows
+
+    db.session.commit()
+    write_state(out_dir, until)
+
+    return exported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export mood data as Parquet or Arrow files partitioned by month')
+    parser.add_argument('--out', default='analytics', help='directory to write files and export state to')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--full', action='store_true', help='export every row, replacing files of earlier runs')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='rows read from the database at a time')
+    parser.add_argument('--wait', type=int, default=60, help='seconds to wait for open transactions to end')
+    parser.add_argument('--db', default='asgard_db')
+    args = parser.parse_args()
+
+    connect_to_db(app, args.db)
+
+    with app.app_context():
+        exported = export_analytics(args.out, args.format, args.full, args.chunk_size, args.wait)
+
+    for table, rows in sorted(exported.items()):
+        print "%s: %s rows" % (table, rows)
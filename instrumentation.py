@@ -0,0 +1,129 @@
+"""Per request SQL instrumentation
+
+Counts statements, time spent in the database and repeated statement shapes
+of each Flask request, from SQLAlchemy engine events. Totals are sent in the
+X-DB-Queries and X-DB-Time-Ms response headers and logged as one JSON line.
+Shapes repeated REPEAT_THRESHOLD times or more in a request (likely lazy loads
+in a loop) are logged as warnings.
+
+With SQL_QUERY_BUDGET in app config, a number or dict of endpoint to number,
+requests issuing more statements than their budget raise QueryBudgetExceeded.
+Meant for tests, to catch N+1 queries.
+"""
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import json
+import logging
+import re
+import timeit
+
+logger = logging.getLogger('moodwatch.sql')
+
+# Statements repeated at least this many times in a request are logged as a possible N+1
+REPEAT_THRESHOLD = 5
+
+# Lists of bound parameters, e.g. IN (%(param_1)s, %(param_2)s), have the same shape whatever their length
+PARAM_LIST = re.compile(r'\((?:\s*%\(\w+\)s\s*,)+\s*%\(\w+\)s\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a request issues more SQL statements than its budget"""
+
+
+class RequestSQLStats(object):
+    """SQL statements issued during a request"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        shape = statement_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def repeated(self):
+        """Gives dict of statement shapes repeated at least REPEAT_THRESHOLD times"""
+
+        return dict((shape, count) for shape, count in self.shapes.items() if count >= REPEAT_THRESHOLD)
+
+
+def statement_shape(statement):
+    """Normalizes a statement so repeats with different parameters compare equal"""
+
+    return PARAM_LIST.sub('(...)', WHITESPACE.sub(' ', statement).strip())
+
+
+def get_request_sql_stats():
+    """Gives SQL stats of current request, None outside of a request"""
+
+    if has_request_context():
+        return getattr(g, 'sql_stats', None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and get_request_sql_stats() is not None:
+        context.sql_start = timeit.default_timer()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = get_request_sql_stats()
+    if stats is not None:
+        start = getattr(context, 'sql_start', None)
+        stats.add(statement, timeit.default_timer() - start if start else 0.0)
+
+
+def start_request_stats():
+    g.sql_stats = RequestSQLStats()
+
+
+def report_request_stats(response):
+    """Adds SQL stats of request to response headers and log, checks query budget"""
+
+    stats = get_request_sql_stats()
+    if stats is None:
+        return response
+
+    response.headers['X-DB-Queries'] = str(stats.count)
+    response.headers['X-DB-Time-Ms'] = '%.1f' % (stats.seconds * 1000)
+
+    repeated = stats.repeated()
+    logger.info(json.dumps({'endpoint': request.endpoint,
+                            'path': request.path,
+                            'status': response.status_code,
+                            'queries': stats.count,
+                            'db_ms': round(stats.seconds * 1000, 1),
+                            'repeated': repeated}))
+    for shape, count in repeated.items():
+        logger.warning('Statement issued %s times in %s, possible N+1: %s', count, request.endpoint, shape)
+
+    budget = get_query_budget(request.endpoint)
+    if budget is not None and stats.count > budget:
+        raise QueryBudgetExceeded('%s issued %s SQL statements, budget is %s'
+                                  % (request.endpoint, stats.count, budget))
+
+    return response
+
+
+def get_query_budget(endpoint):
+    """Gives query budget of an endpoint from SQL_QUERY_BUDGET config, None if there is none"""
+
+    budget = current_app.config.get('SQL_QUERY_BUDGET')
+    if isinstance(budget, dict):
+        return budget.get(endpoint)
+
+    return budget
+
+
+def init_sql_instrumentation(app):
+    """Instruments SQL statements of every request of app"""
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.before_request(start_request_stats)
+    app.after_request(report_request_stats)
@@ -0,0 +1,103 @@
+"""Invalidation of per-process caches across app nodes with PostgreSQL LISTEN/NOTIFY
+
+Writes send notifications on INVALIDATION_CHANNEL in their transaction (see
+model.bump_data_version and model.notify_invalidation), which Postgres delivers
+once they commit. Each app process runs a listener thread on a connection of
+its own, taken out of the pool, and calls the handlers subscribed to a kind of
+message with its argument: 'user:42' calls handlers of 'user' with '42'.
+
+While the listener reconnects messages may be missed, so handlers are then
+called with None, meaning anything of that kind may have changed. Turn it off
+with INVALIDATION_LISTENER = False.
+"""
+
+from model import INVALIDATION_CHANNEL
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import logging
+import select
+import threading
+import time
+
+# Seconds without messages before the connection is checked
+POLL_TIMEOUT = 30
+
+# Seconds between attempts to reconnect
+RECONNECT_DELAY = 5
+
+logger = logging.getLogger('moodwatch.invalidation')
+
+
+class InvalidationListener(object):
+    """Listens for invalidation messages in a daemon thread, started by the first request"""
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+        self.handlers = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+        app.config.setdefault('INVALIDATION_LISTENER', True)
+
+        app.before_first_request(self.start)
+
+    def subscribe(self, kind, handler):
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def start(self):
+        """Starts listener thread, in the process serving requests (after forking)"""
+
+        if not self.app.config['INVALIDATION_LISTENER']:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='invalidation-listener')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def dispatch(self, kind, arg):
+        for handler in self.handlers.get(kind, []):
+            try:
+                handler(arg)
+            except Exception:
+                logger.exception('Invalidation handler of %s failed', kind)
+
+    def dispatch_all(self):
+        for kind in self.handlers:
+            self.dispatch(kind, None)
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception('Invalidation listener lost its connection, reconnecting')
+            time.sleep(RECONNECT_DELAY)
+
+    def listen(self):
+        """Dispatches messages until the connection fails"""
+
+        connection = self.db.get_engine(self.app).raw_connection()
+        # never given back to the pool
+        connection.detach()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN %s' % INVALIDATION_CHANNEL)
+            # messages sent while not listening were missed
+            self.dispatch_all()
+
+            while True:
+                if select.select([dbapi_connection], [], [], POLL_TIMEOUT) == ([], [], []):
+                    # raises if the connection was dropped
+                    cursor.execute('SELECT 1')
+                    continue
+
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    kind, _, arg = dbapi_connection.notifies.pop(0).payload.partition(':')
+                    self.dispatch(kind, arg or None)
+        finally:
+            connection.close()
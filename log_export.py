@@ -0,0 +1,106 @@
+"""Streaming export of a user's whole log history as CSV or NDJSON
+
+Days are read in chunks from a server-side cursor, each with its events and
+the prescriptions active on that day aggregated in the same query, and are
+written out chunk by chunk. Memory use doesn't grow with the length of the
+history and the first rows are sent before the last ones are read.
+"""
+
+from model import db
+from sqlalchemy import text
+from StringIO import StringIO
+import csv
+import json
+
+# Days of a user with their events and prescriptions active on that day
+LOG_HISTORY_SQL = text("""
+    SELECT days.date, days.overall_mood, days.max_mood, days.min_mood, days.notes,
+           day_events.events, day_prescriptions.prescriptions
+    FROM days
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object('event_id', events.event_id,
+                                          'event_name', events.event_name,
+                                          'overall_mood', events.overall_mood,
+                                          'max_mood', events.max_mood,
+                                          'min_mood', events.min_mood,
+                                          'notes', events.notes)
+                        ORDER BY events.event_id) AS events
+        FROM event_days
+        JOIN events ON events.event_id = event_days.event_id
+        WHERE event_days.day_id = days.day_id
+    ) AS day_events ON true
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object('prescription_id', prescriptions.prescription_id,
+                                          'drug', drugs.generic_name,
+                                          'instructions', prescriptions.instructions,
+                                          'start_date', prescriptions.start_date,
+                                          'end_date', prescriptions.end_date)
+                        ORDER BY prescriptions.start_date) AS prescriptions
+        FROM prescriptions
+        JOIN drugs ON drugs.drug_id = prescriptions.drug_id
+        WHERE prescriptions.client_id = days.user_id
+          AND prescriptions.start_date <= days.date
+          AND (prescriptions.end_date IS NULL OR prescriptions.end_date >= days.date)
+    ) AS day_prescriptions ON true
+    WHERE days.user_id = :user_id
+    ORDER BY days.date
+""")
+
+CSV_COLUMNS = ['date', 'overall_mood', 'max_mood', 'min_mood', 'notes', 'events', 'prescriptions']
+
+# Days fetched from the cursor and written out at a time
+EXPORT_CHUNK_SIZE = 500
+
+
+def iter_log_history(user_id, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields lists of a user's days, oldest first, each as a dict with its events and prescriptions"""
+
+    result = db.session.connection(execution_options={'stream_results': True})\
+                       .execute(LOG_HISTORY_SQL, user_id=user_id)
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield [{'date': row.date.isoformat(),
+                'overall_mood': row.overall_mood,
+                'max_mood': row.max_mood,
+                'min_mood': row.min_mood,
+                'notes': row.notes,
+                'events': row.events or [],
+                'prescriptions': row.prescriptions or []} for row in rows]
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
+
+
+def iter_csv(user_id):
+    """Yields a user's history as CSV text, a chunk of days at a time
+
+    Events and prescriptions of a day are listed by name, separated by semicolons.
+    """
+
+    yield ','.join(CSV_COLUMNS) + '\r\n'
+    for days in iter_log_history(user_id):
+        lines = StringIO()
+        writer = csv.writer(lines)
+        for day in days:
+            writer.writerow([day['date'], day['overall_mood'], day['max_mood'], day['min_mood'],
+                             encode(day['notes']),
+                             encode('; '.join(event['event_name'] for event in day['events'])),
+                             encode('; '.join(prescription['drug'] for prescription in day['prescriptions']))])
+        yield lines.getvalue()
+
+
+def iter_ndjson(user_id):
+    """Yields a user's history as newline delimited JSON, one day per line"""
+
+    for days in iter_log_history(user_id):
+        yield ''.join(json.dumps(day) + '\n' for day in days)
+
+
+EXPORT_FORMATS = {'csv': (iter_csv, 'text/csv'),
+                  'ndjson': (iter_ndjson, 'application/x-ndjson')}
@@ -0,0 +1,237 @@
+"""Operational metrics in Prometheus text format
+
+Counters, gauges and histograms registered in REGISTRY are given at /metrics
+by init_metrics. Each process keeps its own values, scrape every worker.
+Metrics of other processes (like the reminder cron job) are written to
+text files with write_textfile and appended to /metrics when listed in
+METRICS_TEXTFILES config.
+"""
+
+from flask import Response, current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from functools import wraps
+import os
+import threading
+import timeit
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def format_labels(labels):
+    """Formats dict of labels as {name="value",...}"""
+
+    if not labels:
+        return ''
+
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in sorted(labels.items())]
+    return '{%s}' % ','.join('%s="%s"' % label for label in escaped)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base of metrics, values are kept for each set of label values"""
+
+    kind = None
+
+    def __init__(self, name, description, labels=(), registry=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def key(self, labels):
+        return tuple(labels.get(label, '') for label in self.labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_value(dict(zip(self.labels, key)), value))
+
+        return lines
+
+    def render_value(self, labels, value):
+        return ['%s%s %s' % (self.name, format_labels(labels), format_value(value))]
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts of observed values in buckets, with their sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        super(Histogram, self).__init__(name, description, labels, registry)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Decorator observing seconds taken by each call of a function"""
+
+        def decorator(function):
+            @wraps(function)
+            def timed(*args, **kwargs):
+                start = timeit.default_timer()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(timeit.default_timer() - start, **labels)
+            return timed
+        return decorator
+
+    def render_value(self, labels, value):
+        counts, total = value
+        lines = ['%s_bucket%s %s' % (self.name, format_labels(dict(labels, le=format_value(bound))), count)
+                 for bound, count in zip(self.buckets, counts)]
+        lines.append('%s_sum%s %s' % (self.name, format_labels(labels), format_value(total)))
+        lines.append('%s_count%s %s' % (self.name, format_labels(labels), counts[-1]))
+        return lines
+
+
+class Registry(object):
+    """Metrics to render together, with collectors updating gauges right before"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, registry):
+    """Writes metrics of a registry to a file, replacing it at once so it's never read half written"""
+
+    with open(path + '.tmp', 'w') as textfile:
+        textfile.write(registry.render())
+    os.rename(path + '.tmp', path)
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = Histogram('moodwatch_request_seconds', 'Time taken to handle requests', ['endpoint', 'status'])
+RESPONSE_BYTES = Histogram('moodwatch_response_bytes', 'Size of response bodies', ['endpoint'],
+                           buckets=SIZE_BUCKETS)
+DB_POOL_CHECKOUTS = Counter('moodwatch_db_pool_checkouts_total', 'Connections checked out of the pool')
+DB_POOL_OVERFLOW_CHECKOUTS = Counter('moodwatch_db_pool_overflow_checkouts_total',
+                                     'Checkouts while every pooled connection was in use, '
+                                     'served by overflow connections or after waiting')
+DB_POOL_CHECKED_OUT = Gauge('moodwatch_db_pool_checked_out', 'Connections in use')
+DB_POOL_SIZE = Gauge('moodwatch_db_pool_size', 'Connections kept in the pool')
+ANALYZE_MOODS_SECONDS = Histogram('moodwatch_analyze_moods_seconds', 'Time taken to compute rolling moods')
+CACHE_REQUESTS = Counter('moodwatch_cache_requests_total', 'Cache lookups by cache and result (hit or miss)',
+                         ['cache', 'result'])
+
+
+def record_cache_lookup(cache, hit):
+    """Counts a lookup in a cache, for hit ratios"""
+
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKOUTS.inc()
+    pool = getattr(connection_proxy, '_pool', None)
+    if pool is not None and hasattr(pool, 'overflow') and pool.overflow() > 0:
+        DB_POOL_OVERFLOW_CHECKOUTS.inc()
+
+
+def init_metrics(app, db):
+    """Records request and pool metrics of app, gives them at /metrics"""
+
+    app.config.setdefault('METRICS_TEXTFILES', ())
+
+    def start_timer():
+        g.metrics_start = timeit.default_timer()
+
+    def record_response(response):
+        g.metrics_status = response.status_code
+        # streamed responses have no length
+        if response.content_length is not None:
+            RESPONSE_BYTES.observe(response.content_length, endpoint=request.endpoint or 'unknown')
+        return response
+
+    def record_request(exception):
+        # run even when the view raised, which skips after_request
+        start = getattr(g, 'metrics_start', None)
+        if start is not None:
+            status = 500 if exception is not None else getattr(g, 'metrics_status', 500)
+            REQUEST_SECONDS.observe(timeit.default_timer() - start,
+                                    endpoint=request.endpoint or 'unknown', status=status)
+
+    def collect_pool():
+        pool = db.get_engine(app).pool
+        if hasattr(pool, 'checkedout'):
+            DB_POOL_CHECKED_OUT.set(pool.checkedout())
+            DB_POOL_SIZE.set(pool.size())
+
+    def show_metrics():
+        text = REGISTRY.render()
+        for path in current_app.config['METRICS_TEXTFILES']:
+            try:
+                with open(path) as textfile:
+                    text += textfile.read()
+            except IOError:
+                pass
+
+        return Response(text, mimetype='text/plain; version=0.0.4')
+
+    event.listen(Pool, 'checkout', count_checkout)
+    REGISTRY.add_collector(collect_pool)
+    app.before_request(start_timer)
+    app.after_request(record_response)
+    app.teardown_request(record_request)
+    app.add_url_rule('/metrics', 'show_metrics', show_metrics)
@@ -2,9 +2,12 @@
     Layout taken from Ratings lab exercise"""
 
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy.orm import make_transient_to_detached
+from collections import namedtuple
+from datetime import datetime, timedelta
 from flask_login import UserMixin
 from bcrypt import hashpw, gensalt
+import json
 
 db = SQLAlchemy()
 
@@ -12,6 +15,11 @@ db = SQLAlchemy()
 ##############################################################################
 # Model definitions
 
+# Gives day logs, event logs and prescriptions increasing change numbers as they
+# are written, so offline clients and analytics exports can read only what changed
+log_change_seq = db.Sequence('log_change_seq', metadata=db.metadata)
+
+
 class User(db.Model, UserMixin):
     """User accounts"""
 
@@ -21,6 +29,9 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(64), nullable=False, unique=True)
     username = db.Column(db.String(64), nullable=False, unique=True)
     password = db.Column(db.String(64), nullable=False)
+    # bumped with every write of the user's days, events or prescriptions, see bump_data_version
+    data_version = db.Column(db.BigInteger, nullable=False, server_default='0')
+    data_modified = db.Column(db.DateTime, nullable=False, server_default=db.text("timezone('utc', now())"))
 
     professional = db.relationship('Professional', uselist=False, backref='user')
 
@@ -34,23 +45,66 @@ class User(db.Model, UserMixin):
 
         return self.user_id
 
+    def get_identity(self):
+        """Returns columns of user and whether they're a professional, to cache between requests"""
+
+        return {'user_id': self.user_id,
+                'email': self.email,
+                'username': self.username,
+                'password': self.password,
+                'is_professional': self.professional is not None}
+
+    @classmethod
+    def from_identity(cls, identity):
+        """Gives user of a cached identity in the current session, without querying it"""
+
+        identity = dict(identity)
+        user = cls(professional=Professional(user_id=identity['user_id'])
+                   if identity.pop('is_professional') else None,
+                   **identity)
+        # make them look loaded from the database, so merge doesn't load or update them
+        if user.professional:
+            make_transient_to_detached(user.professional)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
     def get_active_prescriptions(self):
-        """Returns list of active prescriptions"""
+        """Returns dict of drug name to info of each active prescription, in one query
+
+        has_old tells if the user had an earlier, ended prescription of the same drug.
+        """
+
+        ended = db.aliased(Prescription)
+        has_old = db.exists().where(db.and_(ended.client_id == Prescription.client_id,
+                                            ended.drug_id == Prescription.drug_id,
+                                            ended.end_date != None))
+        prescriptions = db.session.query(Prescription.prescription_id,
+                                         Prescription.drug_id,
+                                         Prescription.pro_id,
+                                         Prescription.instructions,
+                                         Prescription.start_date,
+                                         Prescription.notes,
+                                         Drug.generic_name,
+                                         User.username,
+                                         has_old.label('has_old'))\
+                                  .join(Drug, Drug.drug_id == Prescription.drug_id)\
+                                  .join(User, User.user_id == Prescription.pro_id)\
+                                  .filter(Prescription.client_id == self.user_id,
+                                          Prescription.end_date == None)\
+                                  .order_by(Prescription.start_date, Prescription.prescription_id)
 
         active = {}
-        for prescription in self.prescriptions:
-            if not prescription.end_date:
-                active[prescription.drug.generic_name] \
-                    = {'drug_id': prescription.drug.drug_id,
-                       'prescription_id': prescription.prescription_id,
-                       'pro_id': prescription.professional.user_id,
-                       'pro': prescription.professional.user.username,
-                       'instructions': prescription.instructions,
-                       'start_date': datetime.strftime(prescription.start_date, '%Y-%m-%d'),
-                       'notes': prescription.notes,
-                       'has_old': False}
-            elif active.get(prescription.drug.generic_name):
-                active[prescription.drug.generic_name]['has_old'] = True
+        for prescription in prescriptions:
+            active[prescription.generic_name] \
+                = {'drug_id': prescription.drug_id,
+                   'prescription_id': prescription.prescription_id,
+                   'pro_id': prescription.pro_id,
+                   'pro': prescription.username,
+                   'instructions': prescription.instructions,
+                   'start_date': datetime.strftime(prescription.start_date, '%Y-%m-%d'),
+                   'notes': prescription.notes,
+                   'has_old': prescription.has_old}
 
         return active
 
@@ -77,6 +131,19 @@ class Professional(db.Model):
     def __repr__(self):
         return "<Professional user_id=%s username=%s>" % (self.user_id, self.user.username)
 
+    def sort_clients(self):
+        """Returns dict of active and inactive clients (user objects), in one query"""
+
+        clients = {'active': [], 'inactive': []}
+        contracts = db.session.query(User, Contract.active)\
+                              .join(Contract, Contract.client_id == User.user_id)\
+                              .filter(Contract.pro_id == self.user_id)\
+                              .order_by(User.username)
+        for client, active in contracts:
+            clients['active' if active else 'inactive'].append(client)
+
+        return clients
+
 
 class Contract(db.Model):
     """Contract between professional and client"""
@@ -111,6 +178,9 @@ class Prescription(db.Model):
     end_date = db.Column(db.Date, nullable=True)
     instructions = db.Column(db.Text, nullable=False)
     notes = db.Column(db.Text, nullable=True)
+    change_seq = db.Column(db.BigInteger, nullable=False,
+                           server_default=db.text("nextval('log_change_seq')"),
+                           onupdate=log_change_seq.next_value())
 
     client = db.relationship('User', backref=db.backref("prescriptions", order_by="desc(Prescription.end_date)"))
     drug = db.relationship('Drug', backref=db.backref("prescriptions", order_by="desc(Prescription.end_date)"))
@@ -124,7 +194,8 @@ class Prescription(db.Model):
     def make_dict(self):
         """Makes dict of prescription info"""
 
-        pro = User.query.get(self.pro_id)
+        # no query if the professional is already in the session, e.g. the logged in pro
+        pro = self.professional.user
         med_dict = {}
         med_dict['prescription_id'] = self.prescription_id
         med_dict['pro_id'] = self.pro_id
@@ -141,6 +212,11 @@ class Prescription(db.Model):
 
         return med_dict
 
+# Find active prescriptions of a client without reading ended ones
+db.Index('active_prescription', Prescription.client_id, postgresql_where=Prescription.end_date == None)
+# Find earlier prescriptions of the same drug
+db.Index('client_drug', Prescription.client_id, Prescription.drug_id)
+
 
 class Drug(db.Model):
     """Drug information provided by FDA"""
@@ -157,6 +233,8 @@ class Drug(db.Model):
 
         return "<Drug drug_id=%s generic_name=%s uses=%s>" % (self.drug_id, self.generic_name, self.uses)
 
+db.Index('drug_generic_name', Drug.generic_name, unique=True)
+
 
 class Day(db.Model):
     """Log for a day"""
@@ -170,6 +248,9 @@ class Day(db.Model):
     max_mood = db.Column(db.Integer, nullable=True)
     min_mood = db.Column(db.Integer, nullable=True)
     notes = db.Column(db.Text, nullable=True)
+    change_seq = db.Column(db.BigInteger, nullable=False,
+                           server_default=db.text("nextval('log_change_seq')"),
+                           onupdate=log_change_seq.next_value())
 
     user = db.relationship('User', backref=db.backref('days', order_by='desc(Day.date)'))
 
@@ -188,6 +269,85 @@ class Day(db.Model):
         return info
 
 db.Index('user_date', Day.user_id, Day.date, unique=True)
+# Find changes of a user's days since a sync
+db.Index('day_change', Day.user_id, Day.change_seq)
+
+
+class MoodRollup(db.Model):
+    """Weekly or monthly summary of a user's day logs, kept up to date as days are logged"""
+
+    __tablename__ = "mood_rollups"
+
+    rollup_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    # 'week' or 'month'
+    period = db.Column(db.String(8), nullable=False)
+    period_start = db.Column(db.Date, nullable=False)
+    # stats of overall moods logged in period
+    num_logs = db.Column(db.Integer, nullable=False)
+    mean_mood = db.Column(db.Float, nullable=True)
+    std_mood = db.Column(db.Float, nullable=True)
+    min_mood = db.Column(db.Integer, nullable=True)
+    max_mood = db.Column(db.Integer, nullable=True)
+    # lowest min_mood and highest max_mood logged in period
+    low_mood = db.Column(db.Integer, nullable=True)
+    high_mood = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        """Gives user and period of record"""
+
+        return "<MoodRollup user_id=%s period=%s start=%s>" % (self.user_id, self.period, self.period_start)
+
+db.Index('user_period', MoodRollup.user_id, MoodRollup.period, MoodRollup.period_start, unique=True)
+
+ROLLUP_PERIODS = ('week', 'month')
+
+# Aggregates day logs of the periods given by :periods (one row per user_id, period, period_start)
+# and writes them to mood_rollups, replacing rows already there
+ROLLUP_UPSERT_SQL = """
+    INSERT INTO mood_rollups (user_id, period, period_start, num_logs, mean_mood, std_mood,
+                              min_mood, max_mood, low_mood, high_mood)
+    SELECT periods.user_id,
+           periods.period,
+           periods.period_start,
+           COUNT(days.overall_mood),
+           AVG(days.overall_mood),
+           STDDEV_SAMP(days.overall_mood),
+           MIN(days.overall_mood),
+           MAX(days.overall_mood),
+           MIN(days.min_mood),
+           MAX(days.max_mood)
+    FROM (%(periods)s) AS periods
+    LEFT JOIN days ON days.user_id = periods.user_id
+                  AND days.date >= periods.period_start
+                  AND days.date < periods.period_start + CAST('1 ' || periods.period AS INTERVAL)
+    GROUP BY periods.user_id, periods.period, periods.period_start
+    ON CONFLICT (user_id, period, period_start) DO UPDATE
+    SET num_logs = EXCLUDED.num_logs,
+        mean_mood = EXCLUDED.mean_mood,
+        std_mood = EXCLUDED.std_mood,
+        min_mood = EXCLUDED.min_mood,
+        max_mood = EXCLUDED.max_mood,
+        low_mood = EXCLUDED.low_mood,
+        high_mood = EXCLUDED.high_mood
+"""
+
+# Periods containing given dates of one user
+DATE_PERIODS_SQL = """
+    SELECT DISTINCT CAST(:user_id AS INTEGER) AS user_id,
+                    rollup.period,
+                    CAST(date_trunc(rollup.period, log.date) AS DATE) AS period_start
+    FROM unnest(CAST(:dates AS DATE[])) AS log(date),
+         unnest(CAST(:periods AS TEXT[])) AS rollup(period)
+"""
+
+# Every period of every user that has day logs
+ALL_PERIODS_SQL = """
+    SELECT DISTINCT days.user_id,
+                    rollup.period,
+                    CAST(date_trunc(rollup.period, days.date) AS DATE) AS period_start
+    FROM days, unnest(CAST(:periods AS TEXT[])) AS rollup(period)
+"""
 
 
 class Event(db.Model):
@@ -202,6 +362,9 @@ class Event(db.Model):
     max_mood = db.Column(db.Integer, nullable=True)
     min_mood = db.Column(db.Integer, nullable=True)
     notes = db.Column(db.Text, nullable=True)
+    change_seq = db.Column(db.BigInteger, nullable=False,
+                           server_default=db.text("nextval('log_change_seq')"),
+                           onupdate=log_change_seq.next_value())
 
     user = db.relationship('User', backref=db.backref('events'))
     # Gives days associated with event from start to end date
@@ -234,6 +397,9 @@ class Event(db.Model):
         db.session.add(event_day)
         db.session.commit()
 
+# Find changes of a user's events since a sync
+db.Index('event_change', Event.user_id, Event.change_seq)
+
 
 class EventDay(db.Model):
     """Association table between days and events"""
@@ -246,11 +412,338 @@ class EventDay(db.Model):
 
 # Prevent event from being associate with a unique day more than once
 db.Index('event_day', EventDay.event_id, EventDay.day_id, unique=True)
+# Find events of days without scanning the table
+db.Index('day_event', EventDay.day_id)
+
+
+class SyncMutation(db.Model):
+    """Idempotency key of a log sent by a client to /sync.json, with the result it was given"""
+
+    __tablename__ = "sync_mutations"
+
+    sync_mutation_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    key = db.Column(db.String(64), nullable=False)
+    # JSON, set once the log is applied
+    result = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __repr__(self):
+        """Gives key and user of record"""
+
+        return "<SyncMutation user_id=%s key=%s>" % (self.user_id, self.key)
+
+# A key is applied only once per user
+db.Index('user_sync_key', SyncMutation.user_id, SyncMutation.key, unique=True)
+
+
+# Creates events, a dummy day for each date of their ranges the user hasn't logged
+# and their event_days in one statement. Event ids are drawn up front so rows of
+# logs can be matched to their dates. Days inserted by new_days aren't visible to
+# the other parts of the statement, so existing days are looked up separately.
+LOG_EVENTS_SQL = """
+    WITH logs AS (
+        SELECT nextval('events_event_id_seq') AS event_id, log.*
+        FROM unnest(CAST(:event_names AS TEXT[]), CAST(:start_dates AS DATE[]), CAST(:end_dates AS DATE[]),
+                    CAST(:overall_moods AS INTEGER[]), CAST(:max_moods AS INTEGER[]),
+                    CAST(:min_moods AS INTEGER[]), CAST(:notes AS TEXT[])) WITH ORDINALITY
+             AS log(event_name, start_date, end_date, overall_mood, max_mood, min_mood, notes, position)
+    ), new_events AS (
+        INSERT INTO events (event_id, user_id, event_name, overall_mood, max_mood, min_mood, notes)
+        SELECT event_id, CAST(:user_id AS INTEGER), event_name, overall_mood, max_mood, min_mood, notes
+        FROM logs
+    ), event_dates AS (
+        SELECT logs.event_id, CAST(span.date AS DATE) AS date
+        FROM logs, generate_series(logs.start_date, logs.end_date, INTERVAL '1 day') AS span(date)
+    ), new_days AS (
+        INSERT INTO days (user_id, date)
+        SELECT DISTINCT CAST(:user_id AS INTEGER), event_dates.date
+        FROM event_dates
+        ON CONFLICT (user_id, date) DO NOTHING
+        RETURNING day_id, date
+    ), range_days AS (
+        SELECT day_id, date FROM new_days
+        UNION ALL
+        SELECT days.day_id, days.date
+        FROM days
+        WHERE days.user_id = :user_id
+          AND days.date IN (SELECT date FROM event_dates)
+    ), new_event_days AS (
+        INSERT INTO event_days (event_id, day_id)
+        SELECT event_dates.event_id, range_days.day_id
+        FROM event_dates JOIN range_days ON range_days.date = event_dates.date
+    )
+    SELECT event_id FROM logs ORDER BY position
+"""
+
+# Inserts day logs of a user, replacing moods and notes of dates already logged
+UPSERT_DAYS_SQL = """
+    INSERT INTO days (user_id, date, overall_mood, max_mood, min_mood, notes)
+    SELECT CAST(:user_id AS INTEGER), log.*
+    FROM unnest(CAST(:dates AS DATE[]), CAST(:overall_moods AS INTEGER[]), CAST(:max_moods AS INTEGER[]),
+                CAST(:min_moods AS INTEGER[]), CAST(:notes AS TEXT[]))
+         AS log(date, overall_mood, max_mood, min_mood, notes)
+    ON CONFLICT (user_id, date) DO UPDATE
+    SET overall_mood = EXCLUDED.overall_mood,
+        max_mood = EXCLUDED.max_mood,
+        min_mood = EXCLUDED.min_mood,
+        notes = EXCLUDED.notes,
+        change_seq = nextval('log_change_seq')
+"""
+
+# Claims idempotency keys of a user, gives back the ones not claimed before.
+# A key being claimed by a concurrent sync waits for it to commit.
+CLAIM_SYNC_KEYS_SQL = """
+    INSERT INTO sync_mutations (user_id, key)
+    SELECT CAST(:user_id AS INTEGER), claim.key
+    FROM unnest(CAST(:keys AS TEXT[])) AS claim(key)
+    ON CONFLICT (user_id, key) DO NOTHING
+    RETURNING key
+"""
+
+SAVE_SYNC_RESULTS_SQL = """
+    UPDATE sync_mutations
+    SET result = saved.result
+    FROM unnest(CAST(:keys AS TEXT[]), CAST(:results AS TEXT[])) AS saved(key, result)
+    WHERE sync_mutations.user_id = :user_id
+      AND sync_mutations.key = saved.key
+"""
+
+# Latest change number of a user's logs, 0 if they have none. Writes of a user hold
+# its row lock (bump_data_version) while numbering changes, so no change below the
+# cursor can still be uncommitted.
+CHANGE_CURSOR_SQL = """
+    SELECT COALESCE(GREATEST((SELECT MAX(change_seq) FROM days WHERE user_id = :user_id),
+                             (SELECT MAX(change_seq) FROM events WHERE user_id = :user_id)), 0)
+"""
+
+# Events of a user changed after a change number, with the dates they cover
+CHANGED_EVENTS_SQL = """
+    SELECT events.event_id, events.event_name, events.overall_mood, events.max_mood, events.min_mood,
+           events.notes, MIN(days.date) AS start_date, MAX(days.date) AS end_date, events.change_seq
+    FROM events
+    LEFT JOIN event_days ON event_days.event_id = events.event_id
+    LEFT JOIN days ON days.day_id = event_days.day_id
+    WHERE events.user_id = :user_id
+      AND events.change_seq > :since
+    GROUP BY events.event_id
+    ORDER BY events.change_seq
+"""
+
+# Channel telling app processes to evict cached data, with messages like 'user:<user_id>'
+# and 'drugs'. Notifications are sent on commit, see invalidation.py.
+INVALIDATION_CHANNEL = 'moodwatch_invalidate'
+
+# Marks data of users as changed, for validating cached charts, and tells other processes
+BUMP_DATA_VERSION_SQL = """
+    WITH bumped AS (
+        UPDATE users
+        SET data_version = data_version + 1,
+            data_modified = timezone('utc', now())
+        WHERE user_id = ANY(CAST(:user_ids AS INTEGER[]))
+        RETURNING user_id
+    )
+    SELECT pg_notify(:channel, 'user:' || user_id) FROM bumped
+"""
+
+DayLog = namedtuple('DayLog', ['date', 'overall_mood', 'max_mood', 'min_mood', 'notes'])
+EventLog = namedtuple('EventLog', ['event_name', 'start_date', 'end_date',
+                                   'overall_mood', 'max_mood', 'min_mood', 'notes'])
 
 
 ##############################################################################
 # Helper functions
 
+def refresh_mood_rollups(user_id, dates):
+    """Recomputes weekly and monthly rollups of a user for periods containing dates
+
+    Runs in the current transaction, so pending day logs are flushed first.
+    """
+
+    db.session.flush()
+    db.session.execute(ROLLUP_UPSERT_SQL % {'periods': DATE_PERIODS_SQL},
+                       {'user_id': user_id,
+                        'dates': list(dates),
+                        'periods': list(ROLLUP_PERIODS)})
+
+
+def upsert_days(user_id, logs):
+    """Inserts or replaces DayLogs of a user in one statement, refreshing their rollups
+
+    A date given more than once is logged with its last DayLog. Runs in the
+    current transaction, committing is left to the caller.
+    """
+
+    # a statement can't update the same row twice
+    logs = dict((log.date, log) for log in logs).values()
+    if not logs:
+        return
+
+    # first, so days are numbered by change_seq in the order writes of the user commit
+    bump_data_version(user_id)
+    dates, overall_moods, max_moods, min_moods, notes = zip(*logs)
+    db.session.execute(UPSERT_DAYS_SQL,
+                       {'user_id': user_id,
+                        'dates': list(dates),
+                        'overall_moods': list(overall_moods),
+                        'max_moods': list(max_moods),
+                        'min_moods': list(min_moods),
+                        'notes': list(notes)})
+    refresh_mood_rollups(user_id, dates)
+
+
+def log_events(user_id, logs):
+    """Logs EventLogs of a user with the days they cover in one statement, returns their event_ids
+
+    Runs in the current transaction, committing is left to the caller.
+    """
+
+    if not logs:
+        return []
+
+    # first, so events are numbered by change_seq in the order writes of the user commit
+    bump_data_version(user_id)
+    event_names, start_dates, end_dates, overall_moods, max_moods, min_moods, notes = zip(*logs)
+    result = db.session.execute(LOG_EVENTS_SQL,
+                                {'user_id': user_id,
+                                 'event_names': list(event_names),
+                                 'start_dates': list(start_dates),
+                                 'end_dates': list(end_dates),
+                                 'overall_moods': list(overall_moods),
+                                 'max_moods': list(max_moods),
+                                 'min_moods': list(min_moods),
+                                 'notes': list(notes)})
+
+    return [event_id for event_id, in result]
+
+
+def bump_data_version(*user_ids):
+    """Marks days, events or prescriptions of users as changed, in the current transaction
+
+    Locks the users' rows until commit, so concurrent writes of a user wait for each other
+    and draw change_seq numbers in the order they commit. Sync cursors rely on it.
+    """
+
+    db.session.execute(BUMP_DATA_VERSION_SQL, {'user_ids': list(user_ids), 'channel': INVALIDATION_CHANNEL})
+
+
+def notify_invalidation(message):
+    """Tells app processes to evict cached data of message ('drugs'), once the current transaction commits"""
+
+    db.session.execute("SELECT pg_notify(:channel, :message)",
+                       {'channel': INVALIDATION_CHANNEL, 'message': message})
+
+
+def get_data_version(user_id):
+    """Returns (data_version, data_modified in UTC) of a user, None if there's no such user"""
+
+    return db.session.query(User.data_version, User.data_modified).filter_by(user_id=user_id).first()
+
+
+def claim_sync_keys(user_id, keys):
+    """Records idempotency keys of a user, returns set of the ones that are new"""
+
+    if not keys:
+        return set()
+
+    result = db.session.execute(CLAIM_SYNC_KEYS_SQL, {'user_id': user_id, 'keys': list(keys)})
+
+    return set(key for key, in result)
+
+
+def save_sync_results(user_id, results):
+    """Stores results given for claimed idempotency keys, dict of key to result dict"""
+
+    if results:
+        db.session.execute(SAVE_SYNC_RESULTS_SQL,
+                           {'user_id': user_id,
+                            'keys': results.keys(),
+                            'results': [json.dumps(result) for result in results.values()]})
+
+
+def get_sync_results(user_id, keys):
+    """Returns dict of key to result stored for idempotency keys a user sent before"""
+
+    if not keys:
+        return {}
+
+    mutations = db.session.query(SyncMutation.key, SyncMutation.result)\
+                          .filter(SyncMutation.user_id == user_id,
+                                  SyncMutation.key.in_(keys))
+
+    return dict((key, json.loads(result) if result else None) for key, result in mutations)
+
+
+def get_change_cursor(user_id):
+    """Returns latest change number of a user's day and event logs"""
+
+    return db.session.execute(CHANGE_CURSOR_SQL, {'user_id': user_id}).scalar()
+
+
+def get_changed_logs(user_id, since):
+    """Returns (days, events) of a user written after change number since, oldest change first"""
+
+    days = Day.query.filter(Day.user_id == user_id, Day.change_seq > since)\
+                    .order_by(Day.change_seq).all()
+    events = db.session.execute(CHANGED_EVENTS_SQL, {'user_id': user_id, 'since': since}).fetchall()
+
+    return days, events
+
+
+def rebuild_mood_rollups():
+    """Recomputes rollups of every user from all day logs"""
+
+    db.session.execute(ROLLUP_UPSERT_SQL % {'periods': ALL_PERIODS_SQL},
+                       {'periods': list(ROLLUP_PERIODS)})
+    db.session.commit()
+
+
+def get_period_start(period, date):
+    """Gives start of the week (Monday, as date_trunc) or month containing date"""
+
+    if period == 'week':
+        return date - timedelta(days=date.weekday())
+
+    return date.replace(day=1)
+
+
+def get_mood_rollups(user_id, period, min_date, max_date):
+    """Returns a user's rollups of a period type overlapping a time window, ordered by start"""
+
+    return MoodRollup.query.filter(MoodRollup.user_id == user_id,
+                                   MoodRollup.period == period,
+                                   MoodRollup.period_start <= max_date,
+                                   MoodRollup.period_start >= get_period_start(period, min_date))\
+                           .order_by(MoodRollup.period_start)\
+                           .all()
+
+
+def get_events_by_day(user_id, min_date, max_date):
+    """Returns events of a user's days in a time window, in one query
+
+    Gives dict of day_id to list of (event_id, event_name, overall_mood, notes)
+    so callers don't lazy load day.events for each day.
+    """
+
+    events = db.session.query(EventDay.day_id,
+                              Event.event_id,
+                              Event.event_name,
+                              Event.overall_mood,
+                              Event.notes)\
+                       .join(Event, Event.event_id == EventDay.event_id)\
+                       .join(Day, Day.day_id == EventDay.day_id)\
+                       .filter(Day.user_id == user_id,
+                               Day.date >= min_date,
+                               Day.date <= max_date)\
+                       .order_by(Event.event_id)
+
+    events_by_day = {}
+    for event in events:
+        events_by_day.setdefault(event.day_id, []).append(event[1:])
+
+    return events_by_day
+
+
 def connect_to_db(app, dbname):
     """Connect the database to Flask app."""
 
@@ -1,16 +1,211 @@
-from model import User
-# import numpy as np
+from collections import namedtuple
+
+from sqlalchemy import text
+
+from model import db, Day
+from metrics import ANALYZE_MOODS_SECONDS
+import numpy as np
 import pandas as pd
 
+# Number of day logs the rolling mean/std is computed over
+ROLL_WINDOW = 14
+
+# Longest time window (in days) charted at each resolution before a coarser one is used,
+# keeps long windows at a bounded number of points. Beyond these, moods are charted by month
+RESOLUTION_SPANS = [('day', 366), ('week', 3 * 366)]
+
+RollingMood = namedtuple('RollingMood', ['day_id', 'date', 'overall_mood', 'roll_avg', 'roll_std'])
+
+# Rolling stats are computed over the user_date index with window functions.
+# Only the rows needed for the requested window are read: the window itself plus
+# the (ROLL_WINDOW - 1) logs preceding it, found with an index scan on user_date.
+# Like pandas' rolling(), a stat is only given when every log in the window has a mood.
+ROLLING_MOODS_SQL = text("""
+    SELECT day_id, date, overall_mood, roll_avg, roll_std
+    FROM (SELECT day_id,
+                 date,
+                 overall_mood,
+                 CASE WHEN COUNT(overall_mood) OVER w = %(window)d
+                      THEN CAST(AVG(overall_mood) OVER w AS DOUBLE PRECISION) END AS roll_avg,
+                 CASE WHEN COUNT(overall_mood) OVER w = %(window)d
+                      THEN CAST(STDDEV_SAMP(overall_mood) OVER w AS DOUBLE PRECISION) END AS roll_std
+          FROM days
+          WHERE user_id = :user_id
+            AND date <= :max_date
+            AND date >= COALESCE((SELECT date
+                                  FROM days
+                                  WHERE user_id = :user_id AND date < :min_date
+                                  ORDER BY date DESC
+                                  OFFSET %(offset)d LIMIT 1),
+                                 CAST('-infinity' AS DATE))
+          WINDOW w AS (ORDER BY date ROWS BETWEEN %(preceding)d PRECEDING AND CURRENT ROW)
+         ) AS rolled
+    WHERE date >= :min_date
+    ORDER BY date
+""" % {'window': ROLL_WINDOW, 'preceding': ROLL_WINDOW - 1, 'offset': ROLL_WINDOW - 2})
+
+
+# Rolling stats of many users since a date, the query above run for each user with a lateral join
+CLIENT_ROLLING_MOODS_SQL = text("""
+    SELECT client.user_id, rolled.day_id, rolled.date, rolled.overall_mood, rolled.roll_avg, rolled.roll_std
+    FROM unnest(CAST(:user_ids AS INTEGER[])) AS client(user_id),
+    LATERAL (SELECT day_id,
+                    date,
+                    overall_mood,
+                    CASE WHEN COUNT(overall_mood) OVER w = %(window)d
+                         THEN CAST(AVG(overall_mood) OVER w AS DOUBLE PRECISION) END AS roll_avg,
+                    CASE WHEN COUNT(overall_mood) OVER w = %(window)d
+                         THEN CAST(STDDEV_SAMP(overall_mood) OVER w AS DOUBLE PRECISION) END AS roll_std
+             FROM days
+             WHERE days.user_id = client.user_id
+               AND date >= COALESCE((SELECT date
+                                     FROM days AS earlier
+                                     WHERE earlier.user_id = client.user_id AND date < :min_date
+                                     ORDER BY date DESC
+                                     OFFSET %(offset)d LIMIT 1),
+                                    CAST('-infinity' AS DATE))
+             WINDOW w AS (ORDER BY date ROWS BETWEEN %(preceding)d PRECEDING AND CURRENT ROW)
+            ) AS rolled
+    WHERE rolled.date >= :min_date
+    ORDER BY client.user_id, rolled.date
+""" % {'window': ROLL_WINDOW, 'preceding': ROLL_WINDOW - 1, 'offset': ROLL_WINDOW - 2})
+
+# Date of the last day each user logged a mood, from the end of the user_date index
+LAST_LOG_DATES_SQL = text("""
+    SELECT client.user_id, last_log.date
+    FROM unnest(CAST(:user_ids AS INTEGER[])) AS client(user_id),
+    LATERAL (SELECT date
+             FROM days
+             WHERE days.user_id = client.user_id AND overall_mood IS NOT NULL
+             ORDER BY date DESC
+             LIMIT 1) AS last_log
+""")
+
+@ANALYZE_MOODS_SECONDS.time()
+def analyze_moods(user_id, min_date=None, max_date=None):
+    """Returns rolling mean and std of a user's overall moods between min and max date
 
-def analyze_moods(user_id):
-    r_window = 14
-    user = User.query.get(user_id)
-    days = user.days
-    overall_moods = [day.overall_mood for day in days]
-    moods = pd.Series(overall_moods)
-    roll = moods.rolling(window=r_window)
+    Computed by PostgreSQL window functions, gives a list of rows
+    (day_id, date, overall_mood, roll_avg, roll_std) ordered by date.
+    A day's stats are of its mood and the moods of the 13 days logged before it.
+    roll_avg and roll_std are None when there aren't enough logs in the window.
+    """
+
+    rows = db.session.execute(ROLLING_MOODS_SQL,
+                              {'user_id': user_id,
+                               'min_date': min_date or '-infinity',
+                               'max_date': max_date or 'infinity'})
+
+    return [RollingMood(*row) for row in rows]
+
+
+def analyze_moods_pandas(user_id, min_date=None, max_date=None):
+    """Pandas version of analyze_moods, loads every day log of the user
+
+    Kept to check results of the SQL version.
+    """
+
+    days = Day.query.filter_by(user_id=user_id).order_by(Day.date).all()
+    moods = pd.Series([day.overall_mood for day in days], dtype=float)
+    roll = moods.rolling(window=ROLL_WINDOW)
     roll_mean = roll.mean()
     roll_std = roll.std()
 
-    return [roll_mean, roll_std]
+    rolling_moods = []
+    for i, day in enumerate(days):
+        if (min_date and day.date < min_date) or (max_date and day.date > max_date):
+            continue
+        rolling_moods.append(RollingMood(day.day_id,
+                                         day.date,
+                                         day.overall_mood,
+                                         None if pd.isnull(roll_mean[i]) else float(roll_mean[i]),
+                                         None if pd.isnull(roll_std[i]) else float(roll_std[i])))
+
+    return rolling_moods
+
+
+def choose_resolution(min_date, max_date):
+    """Picks resolution ('day', 'week' or 'month') to chart moods of a time window at"""
+
+    span = (max_date - min_date).days + 1
+    for resolution, max_span in RESOLUTION_SPANS:
+        if span <= max_span:
+            return resolution
+
+    return 'month'
+
+
+def lttb_indices(x, y, max_points):
+    """Picks indices of at most max_points points of a series with Largest-Triangle-Three-Buckets
+
+    First and last points are kept. Points in between are split into buckets and the
+    point of each bucket forming the largest triangle with the point picked before it
+    and the average of the next bucket is kept, so spikes and crashes stay visible.
+    """
+
+    num_points = len(x)
+    if num_points <= max_points or max_points < 3:
+        return np.arange(num_points)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # edges of max_points - 2 buckets splitting points between first and last
+    edges = np.floor(np.linspace(1, num_points - 1, max_points - 1)).astype(int)
+
+    picked = np.empty(max_points, dtype=int)
+    picked[0] = 0
+    picked[-1] = num_points - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x = x[-1]
+            next_y = y[-1]
+        # twice the area of triangles (picked point, bucket point, next bucket average)
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) -
+                       (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(areas.argmax())
+        picked[i + 1] = a
+
+    return picked
+
+
+def summarize_client_moods(user_ids, min_date):
+    """Summarizes moods of many users (a pro's clients) in two queries
+
+    Gives dict of user_id to {'lastlog_date', 'roll_avg', 'roll_std', 'sparkline'},
+    with latest rolling stats and a sparkline of rolling averages since min_date.
+    """
+
+    user_ids = [int(user_id) for user_id in user_ids]
+    summaries = dict((user_id, {'lastlog_date': None,
+                                'roll_avg': None,
+                                'roll_std': None,
+                                'sparkline': []})
+                     for user_id in user_ids)
+    if not user_ids:
+        return summaries
+
+    for user_id, last_date in db.session.execute(LAST_LOG_DATES_SQL, {'user_ids': user_ids}):
+        summaries[user_id]['lastlog_date'] = last_date.isoformat()
+
+    rows = db.session.execute(CLIENT_ROLLING_MOODS_SQL, {'user_ids': user_ids, 'min_date': min_date}).fetchall()
+    moods = pd.DataFrame.from_records(rows, columns=['user_id'] + list(RollingMood._fields))
+    moods = moods[moods['roll_avg'].notnull()]
+    if moods.empty:
+        return summaries
+
+    moods['date'] = pd.to_datetime(moods['date']).dt.strftime('%Y-%m-%d')
+    # rows are ordered by date, so last row of each client has latest stats
+    latest = moods.groupby('user_id').last()
+    for user_id, stats in latest.iterrows():
+        summaries[user_id]['roll_avg'] = float(stats['roll_avg'])
+        summaries[user_id]['roll_std'] = float(stats['roll_std'])
+    for user_id, client_moods in moods.groupby('user_id'):
+        summaries[user_id]['sparkline'] = [{'x': date, 'y': float(roll_avg)}
+                                           for date, roll_avg in zip(client_moods['date'], client_moods['roll_avg'])]
+
+    return summaries
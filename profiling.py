@@ -0,0 +1,141 @@
+"""Opt-in sampling profiler for live requests
+
+A fraction of requests (PROFILE_SAMPLE_RATE, 0 by default) and requests of admins
+(ADMIN_USER_IDS) sending an X-Profile header are run under cProfile. Stats are
+aggregated per endpoint in memory. They are written to PROFILE_DIR as .prof files
+(readable with pstats) by a background thread every PROFILE_DUMP_INTERVAL seconds
+if it is set, and the hottest functions are given to admins at /admin/profile.json.
+
+Requests that aren't sampled only cost a random number, so it can be left on
+in production at a low sample rate.
+"""
+
+from flask import abort, g, jsonify, request, session
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+
+
+class RequestProfiler(object):
+    """Samples requests of an app with cProfile, keeps stats aggregated by endpoint"""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.requests = {}
+        self.last_dump = time.time()
+        self.dumping = False
+
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_DIR', None)
+        app.config.setdefault('PROFILE_DUMP_INTERVAL', 300)
+        app.config.setdefault('ADMIN_USER_IDS', ())
+
+        app.before_request(self.start)
+        app.after_request(self.stop)
+        # after_request handlers are skipped when a view raises
+        app.teardown_request(self.disable)
+        app.add_url_rule('/admin/profile.json', 'get_profile', self.get_profile)
+
+    def is_admin(self):
+        return session.get('user_id') in self.app.config['ADMIN_USER_IDS']
+
+    def should_profile(self):
+        """Samples request at PROFILE_SAMPLE_RATE, or if asked for by an admin"""
+
+        if random.random() < self.app.config['PROFILE_SAMPLE_RATE']:
+            return True
+
+        return 'X-Profile' in request.headers and self.is_admin()
+
+    def start(self):
+        if self.should_profile():
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    def stop(self, response):
+        """Adds profile of a request to stats of its endpoint"""
+
+        profiler = getattr(g, 'profiler', None)
+        if profiler is None:
+            return response
+
+        self.disable()
+        endpoint = request.endpoint or 'unknown'
+        with self.lock:
+            if endpoint in self.stats:
+                self.stats[endpoint].add(profiler)
+            else:
+                self.stats[endpoint] = pstats.Stats(profiler)
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+            directory = self.app.config['PROFILE_DIR']
+            dump_due = (directory and not self.dumping and
+                        time.time() - self.last_dump > self.app.config['PROFILE_DUMP_INTERVAL'])
+            if dump_due:
+                self.dumping = True
+
+        if dump_due:
+            # the sampled request doesn't wait on the disk
+            writer = threading.Thread(target=self.dump, args=(directory,), name='profile-writer')
+            writer.daemon = True
+            writer.start()
+
+        return response
+
+    def disable(self, exception=None):
+        """Stops profiling a request, always run so the profiler never outlives it"""
+
+        profiler = getattr(g, 'profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            g.profiler = None
+
+    def dump(self, directory):
+        """Writes stats of each endpoint to <directory>/<endpoint>.prof, as pstats.Stats.dump_stats does"""
+
+        try:
+            # stats are copied while locked and written after, so requests aren't held up
+            with self.lock:
+                self.last_dump = time.time()
+                dumps = [(endpoint, marshal.dumps(stats.stats)) for endpoint, stats in self.stats.items()]
+
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for endpoint, data in dumps:
+                with open(os.path.join(directory, '%s.prof' % endpoint), 'wb') as prof_file:
+                    prof_file.write(data)
+        finally:
+            self.dumping = False
+
+    def get_hot_functions(self, endpoint, sort='cumulative', limit=20):
+        """Gives functions taking most time in profiled requests of an endpoint"""
+
+        key = 2 if sort == 'total' else 3
+        with self.lock:
+            functions = sorted(self.stats[endpoint].stats.items(), key=lambda item: item[1][key], reverse=True)
+
+        return [{'function': '%s:%s(%s)' % function,
+                 'calls': calls,
+                 'total_ms': round(total * 1000, 2),
+                 'cumulative_ms': round(cumulative * 1000, 2)}
+                for function, (primitive_calls, calls, total, cumulative, callers) in functions[:limit]]
+
+    def get_profile(self):
+        """Route giving hottest functions of each profiled endpoint, for admins only"""
+
+        if not self.is_admin():
+            abort(403)
+
+        sort = request.args.get('sort', 'cumulative')
+        limit = request.args.get('limit', 20, type=int)
+        endpoints = [request.args['endpoint']] if request.args.get('endpoint') else list(self.stats)
+
+        return jsonify(dict((endpoint, {'requests': self.requests[endpoint],
+                                        'functions': self.get_hot_functions(endpoint, sort, limit)})
+                            for endpoint in endpoints if endpoint in self.stats))
@@ -1,12 +1,17 @@
-from model import connect_to_db, db, User, Prescription, Drug, Day, Event, EventDay, Professional, Contract
+from model import connect_to_db, db, User, Prescription, Drug, Day, Event, Professional, Contract, MoodRollup, rebuild_mood_rollups
 from server import app
+from drug_ingest import ingest_drugs
 from random import choice
 from math import sin
 from bcrypt import hashpw, gensalt
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from pytz import timezone
+from datetime import date, datetime, timedelta
+from StringIO import StringIO
+import argparse
+
+# Last day generated moods are logged on, fixed so every seed gives the same data
+SEED_END_DATE = date(2016, 12, 31)
 
 
 def load_drugs():
@@ -14,14 +19,8 @@ def load_drugs():
 
     print "Drugs"
 
-    Drug.query.delete()
-
-    meds = get_meds_from_txt('psych_meds.txt')
-    for med in meds:
-        drug = Drug(generic_name=med[0], brand_name=med[1], uses=med[2])
-        db.session.add(drug)
-
-    db.session.commit()
+    # updated in place, prescriptions refer to drugs
+    ingest_drugs('psych_meds.txt')
 
 
 def load_users():
@@ -108,20 +107,20 @@ def load_prescriptions():
     db.session.commit()
 
 
-def load_days():
-    """ Add days to days table"""
+def load_days(end_date=SEED_END_DATE):
+    """ Add days up to end_date to days table"""
 
     print "Days"
 
     Day.query.delete()
 
-    dates, overall_moods = rand_day_moods()
+    dates, overall_moods = rand_day_moods(end_date=end_date)
 
     # give tyr random moods
-    for i, date in enumerate(dates):
+    for i, day_date in enumerate(dates):
         overall_mood = int(overall_moods[i])
         day = Day(user_id=2,
-                  date=date,
+                  date=day_date,
                   overall_mood=overall_mood)
         db.session.add(day)
 
@@ -132,10 +131,10 @@ def load_days():
     overall_moods = [int(15 * sin(x * 0.1)) for x in range(0, 1001)]
 
     # give loki moods based on sine wave
-    for i, date in enumerate(dates):
+    for i, day_date in enumerate(dates):
         overall_mood = overall_moods[i]
         day = Day(user_id=1,
-                  date=date,
+                  date=day_date,
                   overall_mood=overall_mood,
                   max_mood=overall_mood + choice(MOOD_STEP),
                   min_mood=overall_mood - choice(MOOD_STEP))
@@ -143,6 +142,15 @@ def load_days():
     db.session.commit()
 
 
+def load_mood_rollups():
+    """ Compute weekly and monthly rollups of loaded days"""
+
+    print "Mood rollups"
+
+    MoodRollup.query.delete()
+    rebuild_mood_rollups()
+
+
 def load_events():
     """ Add event to events table"""
 
@@ -152,16 +160,14 @@ def load_events():
 
     user = User.query.get(1)
     nums = [1, -1, -2, 2]
-    for x, i in enumerate(range(0, len(user.days), 3)):
-        day = user.days[i]
-        event = Event(user_id=1,
-                      event_name='event %s' % x,
-                      overall_mood=(day.overall_mood + choice(nums)))
-        db.session.add(event)
-        db.session.commit()
-        event_day = EventDay(event_id=event.event_id, day_id=day.day_id)
-        db.session.add(event_day)
-        db.session.commit()
+    # events are associated with their day through relationship, committed all at once
+    events = [Event(user_id=1,
+                    event_name='event %s' % x,
+                    overall_mood=(user.days[i].overall_mood + choice(nums)),
+                    days=[user.days[i]])
+              for x, i in enumerate(range(0, len(user.days), 3))]
+    db.session.add_all(events)
+    db.session.commit()
 
     event = Event(user_id=1,
                   event_name='Ate an amazing sandwich',
@@ -172,54 +178,165 @@ def load_events():
 
 
 ########################################################
-################ HELPER FUNCTIONS ######################
+############### SYNTHETIC LOAD DATA ####################
 ########################################################
 
 
-def get_meds_from_txt(txt_file):
-    """ Prepares a list of meds from txt file to be made into 'drug' objects
+def load_synthetic(num_users=1000, num_pros=20, years=3, events_per_day=0.3,
+                   prescriptions_per_client=2, chunk_size=200, seed=0, end_date=SEED_END_DATE):
+    """ Add a large, reproducible set of users, pros, contracts, days, events and prescriptions
 
-    Meant to process a txt file created using pdftotext command-line utility
-    on pdf (http://www.namihelps.org/assets/PDFs/fact-sheets/Medications/Commonly-Psyc-Medications.pdf)
+    Rows are generated with numpy from seed and loaded with PostgreSQL COPY,
+    chunk_size users at a time, to reproduce production sized tables in minutes.
+    Synthetic rows are added after existing ones, ids continue from the largest in each table.
+    Days are logged up to end_date.
     """
 
-    with open(txt_file, 'r') as med_txt:
-        # ultimately want a master list of drugs
-        drugs = []
-        # each drug represented by a list [generic, brand, uses]
-        drug = []
-
-        drug_data = {}
-        i = 0
-        labels = ['GENERIC', 'BRAND', 'USES']
-        category = ''
-        for line in med_txt:
-            line = line.strip()
-            if line in labels:
-                category = line
-            elif category:
-                drug_data.setdefault(category, []).append(line)
-            elif i < 3:
-                drug.append(line)
-                i += 1
-            else:
-                drugs.append(drug)
-                drug = [line]
-                i = 1
-
-        for i in range(0, len(drug_data['GENERIC'])):
-            drug = [drug_data['GENERIC'][i], drug_data['BRAND'][i], drug_data['USES'][i]]
-            drugs.append(drug)
-
-    return drugs
-
-
-def rand_day_moods(num_days=1000, tz='US/Pacific'):
-    """ Creates a list of days with random moods """
-
-    ca_tz = timezone(tz)
-    most_recent = datetime.now(ca_tz).date() - timedelta(days=1)
-    first_day = most_recent - timedelta(days=num_days-1)
+    print "Synthetic data: %s users, %s years of days" % (num_users, years)
+
+    rand = np.random.RandomState(seed)
+    # hashing is slow, every synthetic user has the same password
+    password = hashpw('synthetic', gensalt())
+    ids = dict((table, get_max_id(table, column) + 1)
+               for table, column in [('users', 'user_id'), ('days', 'day_id'), ('events', 'event_id'),
+                                     ('event_days', 'event_days_id'), ('contracts', 'contract_id'),
+                                     ('prescriptions', 'prescription_id')])
+
+    # users, first num_pros of them are professionals
+    user_ids = np.arange(ids['users'], ids['users'] + num_users)
+    usernames = pd.Series(user_ids).astype(str)
+    copy_rows('users', pd.DataFrame({'user_id': user_ids,
+                                     'username': 'synthetic' + usernames,
+                                     'email': 'synthetic' + usernames + '@example.com',
+                                     'password': password}))
+    pro_ids = user_ids[:num_pros]
+    client_ids = user_ids[num_pros:]
+    copy_rows('professionals', pd.DataFrame({'user_id': pro_ids}))
+
+    # each client has a contract with a random pro, most are active
+    client_pros = pro_ids[rand.randint(0, len(pro_ids), len(client_ids))] if len(pro_ids) else []
+    if len(client_pros):
+        copy_rows('contracts', pd.DataFrame({'contract_id': np.arange(len(client_ids)) + ids['contracts'],
+                                             'pro_id': client_pros,
+                                             'client_id': client_ids,
+                                             'active': rand.rand(len(client_ids)) < 0.9}))
+        load_synthetic_prescriptions(rand, client_ids, client_pros, prescriptions_per_client,
+                                     years, end_date, ids['prescriptions'])
+    db.session.commit()
+
+    last_date = np.datetime64(end_date)
+    dates = np.arange(last_date - int(years * 365) + 1, last_date + 1)
+    for start in range(0, num_users, chunk_size):
+        ids['days'], ids['events'], ids['event_days'] = load_synthetic_days(
+            rand, user_ids[start:start + chunk_size], dates, events_per_day,
+            ids['days'], ids['events'], ids['event_days'])
+        db.session.commit()
+        print "  days of %s/%s users" % (min(start + chunk_size, num_users), num_users)
+
+    # serial columns continue after explicit ids
+    for table, column in [('users', 'user_id'), ('days', 'day_id'), ('events', 'event_id'),
+                          ('event_days', 'event_days_id'), ('contracts', 'contract_id'),
+                          ('prescriptions', 'prescription_id')]:
+        db.session.execute("SELECT setval(pg_get_serial_sequence('%s', '%s'), "
+                           "(SELECT COALESCE(MAX(%s), 1) FROM %s))" % (table, column, column, table))
+    db.session.commit()
+
+    rebuild_mood_rollups()
+
+
+def load_synthetic_days(rand, user_ids, dates, events_per_day, day_id, event_id, event_days_id):
+    """ Copy days and events of a chunk of users, gives next free day, event and event_day ids"""
+
+    shape = (len(user_ids), len(dates))
+    t = np.arange(len(dates))
+    # slow sine wave with a different phase and period for each user, plus noise
+    phases = rand.uniform(0, 2 * np.pi, (len(user_ids), 1))
+    periods = rand.uniform(30, 120, (len(user_ids), 1))
+    moods = 20 * np.sin(t * 2 * np.pi / periods + phases) + rand.normal(0, 8, shape)
+    moods = np.clip(np.round(moods), -50, 50).astype(int)
+    # some days are skipped
+    logged = (rand.rand(*shape) > 0.1).ravel()
+
+    day_users = np.repeat(user_ids, len(dates))[logged]
+    day_dates = np.tile(dates, len(user_ids))[logged]
+    day_moods = moods.ravel()[logged]
+    num_days = len(day_moods)
+    # half of days have a mood range
+    has_range = rand.rand(num_days) < 0.5
+    day_ids = np.arange(day_id, day_id + num_days)
+    copy_rows('days', pd.DataFrame({
+        'day_id': day_ids,
+        'user_id': day_users,
+        'date': day_dates.astype(str),
+        'overall_mood': day_moods,
+        'min_mood': np.where(has_range, np.maximum(day_moods - rand.randint(1, 25, num_days), -50), np.nan),
+        'max_mood': np.where(has_range, np.minimum(day_moods + rand.randint(1, 25, num_days), 50), np.nan)}))
+
+    # events on each day, one day each
+    event_days = np.repeat(np.arange(num_days), rand.poisson(events_per_day, num_days))
+    num_events = len(event_days)
+    event_ids = np.arange(event_id, event_id + num_events)
+    copy_rows('events', pd.DataFrame({
+        'event_id': event_ids,
+        'user_id': day_users[event_days],
+        'event_name': 'event ' + pd.Series(event_ids).astype(str),
+        'overall_mood': np.clip(day_moods[event_days] + rand.randint(-10, 11, num_events), -50, 50)}))
+    copy_rows('event_days', pd.DataFrame({
+        'event_days_id': np.arange(event_days_id, event_days_id + num_events),
+        'event_id': event_ids,
+        'day_id': day_ids[event_days]}))
+
+    return day_id + num_days, event_id + num_events, event_days_id + num_events
+
+
+def load_synthetic_prescriptions(rand, client_ids, client_pros, per_client, years, end_date, prescription_id):
+    """ Copy prescriptions of clients by their pro, all but the last of each client have ended by end_date"""
+
+    drug_ids = np.array([drug_id for drug_id, in db.session.query(Drug.drug_id)])
+    if not len(drug_ids) or not per_client:
+        return
+
+    num_prescriptions = len(client_ids) * per_client
+    today = np.datetime64(end_date)
+    starts = today - rand.randint(0, int(years * 365), num_prescriptions)
+    ends = starts + rand.randint(7, 180, num_prescriptions)
+    is_last = (np.arange(num_prescriptions) % per_client) == per_client - 1
+    copy_rows('prescriptions', pd.DataFrame({
+        'prescription_id': np.arange(prescription_id, prescription_id + num_prescriptions),
+        'client_id': np.repeat(client_ids, per_client),
+        'pro_id': np.repeat(client_pros, per_client),
+        'drug_id': drug_ids[rand.randint(0, len(drug_ids), num_prescriptions)],
+        'start_date': starts.astype(str),
+        'end_date': pd.Series(np.where(is_last | (ends > today), '', ends.astype(str))).replace('', np.nan),
+        'instructions': 'Take as directed'}))
+
+
+########################################################
+################ HELPER FUNCTIONS ######################
+########################################################
+
+
+def copy_rows(table, frame):
+    """ Loads rows of a dataframe into a table with PostgreSQL COPY, in the current transaction"""
+
+    rows = StringIO()
+    # ints with missing values are floats in pandas, written back without decimals
+    frame.to_csv(rows, sep='\t', header=False, index=False, na_rep='\\N', float_format='%d')
+    rows.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_from(rows, table, columns=list(frame.columns))
+
+
+def get_max_id(table, column):
+    """ Gets largest id in a table, 0 if empty"""
+
+    return db.session.execute('SELECT COALESCE(MAX(%s), 0) FROM %s' % (column, table)).scalar()
+
+
+def rand_day_moods(num_days=1000, end_date=SEED_END_DATE):
+    """ Creates a list of days up to end_date with random moods """
+
+    first_day = end_date - timedelta(days=num_days-1)
 
     random_moods = pd.Series((np.random.rand(num_days) * 20) - (20/2))
     offsets = [(x * .03 - 15) for x in range(1, 1001)]
@@ -234,7 +351,21 @@ def rand_day_moods(num_days=1000, tz='US/Pacific'):
 
 
 if __name__ == "__main__":
-    connect_to_db(app, 'asgard_db')
+    parser = argparse.ArgumentParser(description='Seed database with example data')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='also load a large generated dataset, for measuring performance')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--pros', type=int, default=20)
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--events-per-day', type=float, default=0.3)
+    parser.add_argument('--prescriptions-per-client', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--end-date', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(),
+                        default=SEED_END_DATE, help='last day moods are logged on, YYYY-MM-DD')
+    parser.add_argument('--db', default='asgard_db')
+    args = parser.parse_args()
+
+    connect_to_db(app, args.db)
 
     # In case tables haven't been created, create them
     db.create_all()
@@ -245,5 +376,15 @@ if __name__ == "__main__":
     load_professionals()
     load_contracts()
     load_prescriptions()
-    load_days()
+    load_days(args.end_date)
+    load_mood_rollups()
     load_events()
+
+    if args.synthetic:
+        load_synthetic(num_users=args.users,
+                       num_pros=args.pros,
+                       years=args.years,
+                       events_per_day=args.events_per_day,
+                       prescriptions_per_client=args.prescriptions_per_client,
+                       seed=args.seed,
+                       end_date=args.end_date)
@@ -1,15 +1,31 @@
 from jinja2 import StrictUndefined
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from flask import Flask, jsonify, render_template, request, redirect, flash, session
+from flask import (Flask, Response, abort, jsonify, render_template, request, redirect, flash, session,
+                   stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
-from flask_login import LoginManager, login_user, logout_user, login_required
-
-from model import connect_to_db, db, User, Drug, Prescription, Day, Event
-from mood_analysis import analyze_moods
+from flask_login import LoginManager, current_user, login_user, logout_user, login_required
+
+from model import (connect_to_db, db, User, Prescription, Day, Contract, DayLog, EventLog, ROLLUP_PERIODS,
+                   bump_data_version, claim_sync_keys, get_change_cursor, get_changed_logs, get_data_version,
+                   get_events_by_day, get_mood_rollups, get_sync_results, log_events, save_sync_results,
+                   upsert_days)
+from instrumentation import init_sql_instrumentation
+from metrics import init_metrics, record_cache_lookup
+from profiling import RequestProfiler
+from log_export import EXPORT_FORMATS
+from cache import LRUCache, TTLCache
+from drug_catalog import catalog
+from invalidation import InvalidationListener
+from mood_analysis import analyze_moods, choose_resolution, lttb_indices, summarize_client_moods
 from bcrypt import hashpw, gensalt
+from functools import wraps
 import numpy as np
+import csv
+import hashlib
+import json
+import os
 
 app = Flask(__name__)
 
@@ -20,6 +36,17 @@ app.secret_key = "ABC"
 app.jinja_env.undefined = StrictUndefined
 app.jinja_env.auto_reload = True
 
+# Count SQL statements and time of each request
+init_sql_instrumentation(app)
+
+# Profile sampled requests, see PROFILE_SAMPLE_RATE and ADMIN_USER_IDS config
+profiler = RequestProfiler(app)
+
+# Request, pool and reminder metrics at /metrics
+app.config['METRICS_TEXTFILES'] = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                'cron_code', 'reminder_metrics.prom')]
+init_metrics(app, db)
+
 ##########################################################################
 ###########################   LOGIN MANAGER   ############################
 ##########################################################################
@@ -28,11 +55,31 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = '/'
 
+# Seconds identities of logged in users are cached between requests, 0 turns it off
+app.config.setdefault('IDENTITY_CACHE_TTL', 0)
+identity_cache = TTLCache()
+
 
 @login_manager.user_loader
 def user_loader(user_id):
-    """ User loader callback to load user object from id stored in session """
-    return User.query.get(user_id)
+    """ User loader callback to load user object from id stored in session
+
+    Runs once per request, handlers use current_user instead of loading the user again.
+    Professional is loaded with the user, so checking user.professional doesn't query.
+    """
+
+    ttl = app.config['IDENTITY_CACHE_TTL']
+    if ttl:
+        identity = identity_cache.get(user_id)
+        record_cache_lookup('identity', identity is not None)
+        if identity is not None:
+            return User.from_identity(identity)
+
+    user = User.query.options(db.joinedload('professional')).get(user_id)
+    if user and ttl:
+        identity_cache.set(user_id, user.get_identity(), ttl)
+
+    return user
 
 
 ##########################################################################
@@ -107,10 +154,8 @@ def logout():
 def show_user_dashboard():
     """Show user profile page"""
 
-    user_id = session['user_id']
-
-    # Retrieve user object and pass it into profile template
-    user = db.session.query(User).get(user_id)
+    # Logged in user loaded by user_loader is passed into profile template
+    user = current_user
     # today = datetime.today().date()
     if user.professional:
         return render_template('pro_dashboard.html', pro=user)
@@ -126,42 +171,82 @@ def show_user_dashboard():
 @app.route('/user_logs')
 @login_required
 def display_day_mood_chart():
-    user = User.query.get(session['user_id'])
+    user = current_user
     return render_template('mood_chart.html',
                            user_info={'user': user,
                                       'daylog_info': user.get_daylog_info()}
                            )
 
 
+# Drugs given per page of /drugs and /drugs.json
+DRUGS_PAGE_SIZE = 50
+
+
 @app.route('/drugs')
 @login_required
 def drug_list():
     """ Show a list of all drugs in database"""
 
-    user_id = session.get('user_id')
-
-    # Retrieve user object and pass it into profile template
-    user = db.session.query(User).get(user_id)
+    # Logged in user loaded by user_loader is passed into profile template
+    user = current_user
     # today = datetime.today().date()
     if user.professional:
-        # Get a list of all drug objects
-        drugs = Drug.query.all()
+        # First page of drugs, the rest is searched with /drugs.json
+        drugs, total = catalog.search('', 0, DRUGS_PAGE_SIZE)
 
-        return render_template('drugs.html', drugs=drugs, pro=user)
+        return render_template('drugs.html', drugs=drugs, total=total, page_size=DRUGS_PAGE_SIZE, pro=user)
 
     flash('Only healthcare professionals can access drug database')
     return redirect('/user_dashboard')
 
 
+@app.route('/drugs.json')
+@login_required
+def search_drugs():
+    """ Returns a page of drugs with a generic or brand name starting with q, or similar to it"""
+
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', DRUGS_PAGE_SIZE, type=int), 1), DRUGS_PAGE_SIZE)
+    drugs, total = catalog.search(request.args.get('q', ''), offset, limit)
+
+    return jsonify({'drugs': drugs, 'total': total, 'offset': offset, 'limit': limit})
+
+
 ##########################################################################
 ########################### PRO USER ROUTES  #############################
 ##########################################################################
+@app.route('/client_roster.json')
+@login_required
+def get_client_roster():
+    """Returns mood overview of every active client of pro in one request
+
+    Each client has last log date, latest rolling mean/std and a sparkline
+    of rolling averages since minDate (defaults to the last 30 days).
+    """
+
+    pro = current_user
+    if not pro.professional:
+        return jsonify(None)
+
+    if request.args.get('minDate'):
+        min_date = datetime.strptime(request.args.get('minDate'), '%Y-%m-%d').date()
+    else:
+        min_date = datetime.today().date() - timedelta(days=30)
+
+    clients = pro.professional.sort_clients()['active']
+    summaries = summarize_client_moods([client.user_id for client in clients], min_date)
+    roster = [dict(summaries[client.user_id], user_id=client.user_id, username=client.username)
+              for client in clients]
+
+    return jsonify({'clients': roster})
+
+
 @app.route('/client_active_meds.json')
 @login_required
 def get_client_prescriptions():
     """Returns active prescriptions for a specific client"""
 
-    pro = db.session.query(User).get(session['user_id'])
+    pro = current_user
     client_id = int(request.args.get('clientId'))
     client = db.session.query(User).get(client_id)
     if pro.professional:
@@ -186,20 +271,29 @@ def get_client_prescriptions():
 
 
 @app.route('/end_prescription.json', methods=['POST'])
+@login_required
 def end_prescription():
     """ Ends Prescription """
 
     prescription_id = int(request.form.get('prescriptionId'))
     end_date = datetime.strptime(request.form.get('currentDate'), '%Y-%m-%d').date()
 
-    prescription = Prescription.query.get(prescription_id)
+    # load prescribing pro along, for make_dict
+    prescription = Prescription.query.options(db.joinedload('professional').joinedload('user'))\
+                                     .get(prescription_id)
     prescription.end_date = end_date
+    # made before commit expires everything, which would reload it
+    med_dict = prescription.make_dict()
+    client_id = prescription.client_id
+    bump_data_version(client_id)
     db.session.commit()
+    chart_cache.delete_tag(client_id)
 
-    return jsonify(prescription.make_dict())
+    return jsonify(med_dict)
 
 
 @app.route('/add_prescription.json', methods=['POST'])
+@login_required
 def process_prescription():
     """ Add new prescription """
 
@@ -218,11 +312,16 @@ def process_prescription():
                                 notes=notes)
 
     db.session.add(prescription)
+    db.session.flush()
+    # made before commit expires everything, prescribing pro is the logged in user
+    med_dict = prescription.make_dict()
+    bump_data_version(client_id)
     db.session.commit()
+    chart_cache.delete_tag(client_id)
 
     # flash('Prescription added')
 
-    return jsonify(prescription.make_dict())
+    return jsonify(med_dict)
 
 
 ##########################################################################
@@ -238,29 +337,20 @@ def process_day_mood_log():
     date = datetime.strptime(request.form.get('today-date'), '%Y-%m-%d').date()
     user_id, overall_mood, min_mood, max_mood, notes = get_mood_rating()
 
-    day = Day.query.filter_by(user_id=user_id, date=date).first()
-
-    if day:
-        day.overall_mood = overall_mood
-        day.min_mood = min_mood
-        day.max_mood = max_mood
-        day.notes = notes
-    else:
-        day = Day(user_id=user_id,
-                  date=date,
-                  overall_mood=overall_mood,
-                  max_mood=max_mood,
-                  min_mood=min_mood,
-                  notes=notes)
-        db.session.add(day)
-
+    # insert or replace the day log and its rollups in one transaction
+    upsert_days(user_id, [DayLog(date, overall_mood, max_mood, min_mood, notes)])
     db.session.commit()
+    chart_cache.delete_tag(user_id)
     # day_datapoint = {'date': datetime.strftime(day.date, '%Y-%m-%d'),
     #                  'overall_mood': day.overall_mood}
 
     return redirect('/user_dashboard')
 
 
+# Most days an event can last, each is given a day log
+MAX_EVENT_DAYS = 366
+
+
 @app.route('/log_event_mood', methods=['POST'])
 @login_required
 def process_event_mood_log():
@@ -269,31 +359,152 @@ def process_event_mood_log():
     # get user inputs
     event_name = request.form.get('event-name')
     event_date = datetime.strptime(request.form.get('today-event-date'), '%Y-%m-%d').date()
-    # end_date = datetime.strptime(request.form.get('end-date'), '%Y-%m-%d').date()
+    # events last one day unless an end date is given
+    end_date = event_date
+    if request.form.get('end-date'):
+        end_date = max(datetime.strptime(request.form.get('end-date'), '%Y-%m-%d').date(), event_date)
+    if (end_date - event_date).days >= MAX_EVENT_DAYS:
+        flash('Events can last at most %s days' % MAX_EVENT_DAYS)
+        return redirect('/user_dashboard')
     user_id, overall_mood, min_mood, max_mood, notes = get_mood_rating()
-    # create event
-    event = Event(event_name=event_name,
-                  user_id=user_id,
-                  overall_mood=overall_mood,
-                  max_mood=max_mood,
-                  min_mood=min_mood,
-                  notes=notes)
-    db.session.add(event)
+    # create event with its days in one transaction
+    log_events(user_id, [EventLog(event_name, event_date, end_date, overall_mood, max_mood, min_mood, notes)])
     db.session.commit()
-
-    event.associate_day(event_date)
+    chart_cache.delete_tag(user_id)
     # flash('Event %s on today (%s) successfully created' % (event_name, event_date))
 
     return redirect('/user_dashboard')
 
 
+# Logs applied per statement by /import_logs
+IMPORT_BATCH_SIZE = 1000
+
+
+@app.route('/import_logs', methods=['POST'])
+@login_required
+def import_logs():
+    """ Imports day and event logs from a CSV or JSON array, e.g. history from another app
+
+    Rows have date, overall_mood and optionally min_mood, max_mood and notes.
+    Event rows also have type 'event', event_name and optionally end_date.
+    Logs are applied in batches, all in one transaction so a bad row imports nothing.
+    """
+
+    user_id = session['user_id']
+    days = []
+    events = []
+    num_days = 0
+    num_events = 0
+    try:
+        for row_num, row in enumerate(read_import_rows(), 1):
+            log = parse_import_row(row, row_num)
+            if isinstance(log, EventLog):
+                events.append(log)
+            else:
+                days.append(log)
+
+            if len(days) >= IMPORT_BATCH_SIZE:
+                upsert_days(user_id, days)
+                num_days += len(days)
+                days = []
+            if len(events) >= IMPORT_BATCH_SIZE:
+                log_events(user_id, events)
+                num_events += len(events)
+                events = []
+    except ValueError as error:
+        db.session.rollback()
+        return jsonify({'error': str(error)}), 400
+
+    upsert_days(user_id, days)
+    log_events(user_id, events)
+    db.session.commit()
+    chart_cache.delete_tag(user_id)
+
+    return jsonify({'days': num_days + len(days), 'events': num_events + len(events)})
+
+
+# Most mutations a client can send to /sync.json at once
+SYNC_MAX_MUTATIONS = 1000
+
+
+@app.route('/sync.json', methods=['POST'])
+@login_required
+def sync_logs():
+    """ Applies day and event logs queued by an offline client, gives changes since its last sync
+
+    Takes {"mutations": [...], "since": cursor}. Mutations are rows like those of
+    /import_logs with a client made "key", a key already applied isn't applied
+    again and gets its first result back. All valid mutations are applied in one
+    transaction. Changes written after cursor "since" are given if it's sent,
+    with a new cursor to send next time.
+    """
+
+    user_id = session['user_id']
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('mutations', []), list):
+        return jsonify({'error': 'Expected {"mutations": [...], "since": cursor}'}), 400
+
+    since = payload.get('since')
+    if since is not None and (not isinstance(since, (int, long)) or isinstance(since, bool)):
+        return jsonify({'error': 'since must be a cursor given by a previous sync'}), 400
+
+    mutations = payload.get('mutations', [])
+    if len(mutations) > SYNC_MAX_MUTATIONS:
+        return jsonify({'error': 'At most %s mutations can be synced at once' % SYNC_MAX_MUTATIONS}), 400
+
+    results = {}
+    logs = []
+    for position, mutation in enumerate(mutations, 1):
+        key = mutation.get('key') if isinstance(mutation, dict) else None
+        if not key or not isinstance(key, basestring) or len(key) > 64:
+            return jsonify({'error': 'Mutation %s: key must be a string of at most 64 characters'
+                                     % position}), 400
+        if key in results:
+            continue
+        try:
+            logs.append((key, parse_import_row(mutation, position)))
+            results[key] = None
+        except ValueError as error:
+            # not claimed, so it can be fixed and sent again
+            results[key] = {'key': key, 'status': 'error', 'error': str(error)}
+
+    claimed = claim_sync_keys(user_id, [log_key for log_key, parsed in logs])
+    days = [(log_key, parsed) for log_key, parsed in logs if log_key in claimed and isinstance(parsed, DayLog)]
+    events = [(log_key, parsed) for log_key, parsed in logs if log_key in claimed and isinstance(parsed, EventLog)]
+
+    upsert_days(user_id, [parsed for log_key, parsed in days])
+    event_ids = log_events(user_id, [parsed for log_key, parsed in events])
+
+    applied = {}
+    for key, log in days:
+        applied[key] = {'key': key, 'status': 'applied', 'type': 'day', 'date': log.date.isoformat()}
+    for (key, log), event_id in zip(events, event_ids):
+        applied[key] = {'key': key, 'status': 'applied', 'type': 'event', 'event_id': event_id}
+    save_sync_results(user_id, applied)
+    results.update(applied)
+
+    for key, result in get_sync_results(user_id, [key for key, log in logs if key not in claimed]).items():
+        results[key] = dict(result or {'key': key, 'status': 'applied'}, duplicate=True)
+
+    response = {'results': [results[key] for key in unique_keys(mutations)],
+                'cursor': get_change_cursor(user_id)}
+    if since is not None:
+        response['changes'] = make_sync_changes(*get_changed_logs(user_id, since))
+    db.session.commit()
+    chart_cache.delete_tag(user_id)
+
+    return jsonify(response)
+
+
 @app.route('/logs_html.json')
 @login_required
 def get_logs_for_day():
     """ Returns info of logs formatted in html to display as search results"""
 
     requested_date = datetime.strptime(request.args.get('searchDate'), '%Y-%m-%d').date()
-    day = Day.query.filter_by(user_id=session['user_id'], date=requested_date).first()
+    # load day with its events in one query
+    day = Day.query.options(db.joinedload('events'))\
+                   .filter_by(user_id=session['user_id'], date=requested_date).first()
     if day:
         day_info = day.get_info_dict()
         day_html = '<h3>On this day, you rated your moods: </h3><ul>'
@@ -325,93 +536,201 @@ def get_logs_for_day():
     return jsonify(None)
 
 
+@app.route('/export_logs.<any(csv, ndjson):export_format>')
+@login_required
+def export_logs(export_format):
+    """ Streams a user's whole log history as CSV or NDJSON
+
+    Pros can export a client's history (clientId) while their contract is active.
+    """
+
+    user_id = session['user_id']
+    client_id = request.args.get('clientId', type=int)
+    if client_id and client_id != user_id:
+        contract = Contract.query.filter_by(pro_id=user_id, client_id=client_id, active=True).first()
+        if not contract:
+            abort(403)
+        user_id = client_id
+
+    iter_rows, mimetype = EXPORT_FORMATS[export_format]
+    response = Response(stream_with_context(iter_rows(user_id)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=moodwatch_%s.%s' % (user_id, export_format)
+
+    return response
+
+
 ##########################################################################
 ##########################  MOOD CHART ROUTES  ###########################
 ##########################################################################
 
 
+CHART_RESOLUTIONS = ('day',) + ROLLUP_PERIODS
+# Fewest points a chart series can be decimated to
+MIN_CHART_POINTS = 10
+
+# Chart.js styles of mood chart datasets, sent once per response in columnar format
+MOOD_CHART_STYLES = {'day': {'pointBackgroundColor': 'rgba(67,124,234,0.3)',
+                             'pointBorderColor': 'rgba(67,124,234,0.7)',
+                             'pointRadius': 3.5},
+                     'event': {'pointRadius': 5,
+                               'backgroundColor': 'rgba(0,0,0,0)',
+                               'borderColor': 'rgba(0,0,0,0)'},
+                     'roll': {'backgroundColor': 'rgba(0,0,0,0)',
+                              'borderColor': 'rgba(0,0,0,0)',
+                              'pointBackgroundColor': 'rgba(0,0,0,0)',
+                              'pointBorderColor': 'rgba(0,0,0,0)'}}
+
+
+# Bytes of chart responses cached by each worker, at most CHART_CACHE_MAX_BYTES.
+# Turned off with CHART_CACHE = False, e.g. to measure making charts.
+app.config.setdefault('CHART_CACHE', True)
+app.config.setdefault('CHART_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+chart_cache = LRUCache()
+
+
+@app.before_first_request
+def size_chart_cache():
+    """Caps chart_cache at CHART_CACHE_MAX_BYTES, read once the app is configured"""
+
+    chart_cache.max_bytes = app.config['CHART_CACHE_MAX_BYTES']
+
+
+# Caches of this process are evicted when other processes write, see invalidation.py
+invalidation_listener = InvalidationListener(app, db)
+
+
+def evict_user_caches(user_id):
+    """Evicts cached identity and charts of a user written by any process, of every user if None"""
+
+    if user_id is None:
+        identity_cache.clear()
+        chart_cache.clear()
+    else:
+        identity_cache.delete(int(user_id))
+        chart_cache.delete_tag(int(user_id))
+
+
+invalidation_listener.subscribe('user', evict_user_caches)
+invalidation_listener.subscribe('drugs', lambda arg: catalog.invalidate())
+
+
+def conditional_on_data_version(get_user_id):
+    """Makes a chart view answer If-None-Match with 304 while the charted user's data is unchanged
+
+    The ETag comes from the logged in user, the charted user's data version and the
+    query string, so a revalidation only loads the charted user and the view isn't run.
+    The logged in user's version is loaded along with them by user_loader.
+    Responses are also kept in chart_cache by ETag and tagged with the charted user,
+    so other requests for the same chart are served without running the view either.
+    A request racing a write can't cache stale data under the new version.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(*args, **kwargs):
+            user_id = get_user_id()
+            if user_id and user_id == session.get('user_id'):
+                version = (current_user.data_version, current_user.data_modified)
+            else:
+                version = get_data_version(user_id) if user_id else None
+            if version is None:
+                return view(*args, **kwargs)
+
+            data_version, data_modified = version
+            etag = hashlib.sha1('%s:%s:%s:%s:%s' % (session.get('user_id'), user_id, data_version,
+                                                    request.path, request.query_string)).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                use_cache = app.config['CHART_CACHE']
+                body = chart_cache.get(etag, tag=user_id) if use_cache else None
+                if use_cache:
+                    record_cache_lookup('chart', body is not None)
+                if body is not None:
+                    response = Response(body, mimetype='application/json')
+                else:
+                    response = app.make_response(view(*args, **kwargs))
+                    if use_cache and response.status_code == 200:
+                        chart_cache.set(etag, response.get_data(), tag=user_id)
+            response.set_etag(etag)
+            response.last_modified = data_modified
+            # browsers keep the chart, but check it's current before using it
+            response.headers['Cache-Control'] = 'private, no-cache'
+
+            return response
+
+        return conditional_view
+
+    return decorator
+
+
 @app.route('/mood_chart.json')
 @login_required
+@conditional_on_data_version(lambda: session['user_id'])
 def get_mood_chart_data():
-    """ Return relevant data to display on chart.js """
+    """ Return relevant data to display on chart.js
 
-    user = User.query.get(session['user_id'])
-    min_date = datetime.strptime(request.args.get('minDate'), '%Y-%m-%d').date()
-    max_date = datetime.strptime(request.args.get('maxDate'), '%Y-%m-%d').date()
-    roll_avg, roll_std = analyze_moods(session['user_id'])
-    roll_avg_dataset = []
-    roll_std_dataset = []
+    With format=columnar, gives parallel arrays of dates, moods and rolling stats
+    plus styles once, to be expanded into datasets by static/mood_chart.js
 
-    # initialize master list of datasets
-    datasets = []
-    # create a dataset for each day's range
-    for i, day in enumerate(user.days):
-        # only for days between requested time window that have an overall mood
-        if (day.overall_mood is not None) and (min_date <= day.date) and (day.date <= max_date):
-            # format date into moment.js format to be plottable on chart.js
-            date = datetime.strftime(day.date, '%Y-%m-%d')
+    Long time windows are charted from weekly/monthly rollups, the resolution
+    is picked from the window unless given by resolution=day|week|month.
+    With max_points, series are decimated to at most that many dates.
+    """
 
-            # initialize dataset with point(date, overall_mood)
-            day_dataset = [{'x': date, 'y': day.overall_mood}]
-            # if there is a mood range (check by or, in cases min or max is 0)
-            # if day.min_mood or day.max_mood:
-            #     # extend the day's mood dataset with the range values
-            #     day_dataset.extend([{'x': date, 'y': day.min_mood},
-            #                         {'x': date, 'y': day.max_mood}])
-            # append day dataset to the master list of datasets
-            datasets.append({'label': 'Day %s' % date,
-                             'pointBackgroundColor': 'rgba(67,124,234,0.3)',
-                             'pointBorderColor': 'rgba(67,124,234,0.7)',
-                             'pointRadius': 3.5,
-                             'data': day_dataset})
+    min_date = datetime.strptime(request.args.get('minDate'), '%Y-%m-%d').date()
+    max_date = datetime.strptime(request.args.get('maxDate'), '%Y-%m-%d').date()
+    resolution = request.args.get('resolution')
+    if resolution not in CHART_RESOLUTIONS:
+        resolution = choose_resolution(min_date, max_date)
 
-            if (not np.isnan(roll_avg[i])):
-                roll_avg_dataset.append({'x': date, 'y': roll_avg[i]})
-                roll_std_dataset.append({'x': date, 'y': roll_std[i]})
+    if resolution == 'day':
+        chart = get_day_mood_chart(session['user_id'], min_date, max_date)
+    else:
+        chart = get_rollup_mood_chart(session['user_id'], resolution, min_date, max_date)
+    chart['resolution'] = resolution
 
-            # also append events for logged (no dummy) days
-            for event in day.events:
-                if event.overall_mood:
-                    event_dataset = [{'x': date, 'y': event.overall_mood}]
-                    datasets.append({'label': 'event',
-                                     'pointRadius': 5,
-                                     'backgroundColor': 'rgba(0,0,0,0)',
-                                     'borderColor': 'rgba(0,0,0,0)',
-                                     'data': event_dataset})
-
-    datasets.append({'label': 'roll-avg',
-                     'backgroundColor': 'rgba(0,0,0,0)',
-                     'borderColor': 'rgba(0,0,0,0)',
-                     'pointBackgroundColor': 'rgba(0,0,0,0)',
-                     'pointBorderColor': 'rgba(0,0,0,0)',
-                     'data': roll_avg_dataset})
+    max_points = get_max_points()
+    if max_points:
+        downsample_mood_chart(chart, max_points)
 
-    datasets.append({'label': 'roll-std',
-                     'backgroundColor': 'rgba(0,0,0,0)',
-                     'borderColor': 'rgba(0,0,0,0)',
-                     'pointBackgroundColor': 'rgba(0,0,0,0)',
-                     'pointBorderColor': 'rgba(0,0,0,0)',
-                     'data': roll_std_dataset})
+    if request.args.get('format') == 'columnar':
+        chart['format'] = 'columnar'
+        chart['styles'] = MOOD_CHART_STYLES
+        return jsonify(chart)
 
-    return jsonify({'datasets': datasets})
+    return jsonify({'datasets': make_mood_chart_datasets(chart)})
 
 
 @app.route('/client_log_overview.json')
 @login_required
+@conditional_on_data_version(lambda: request.args.get('clientId', type=int))
 def get_client_log_overview():
-    """ Return 'smoothened' moods for a user"""
+    """ Return 'smoothened' moods for a user, decimated to max_points if given"""
 
     client_id = request.args.get('clientId')
-    client = User.query.get(client_id)
-    roll_avg, roll_std = analyze_moods(client_id)
+    first_date, last_date = db.session.query(db.func.min(Day.date), db.func.max(Day.date))\
+                                      .filter(Day.user_id == client_id).one()
     roll_avg_dataset = []
     datasets = []
-    # create a dataset for each day's range
-    for i, day in enumerate(client.days):
-        date = datetime.strftime(day.date, '%Y-%m-%d')
 
-        if (not np.isnan(roll_avg[i])):
-            roll_avg_dataset.append({'x': date, 'y': roll_avg[i]})
+    # whole history is charted, from rollups if it is long
+    resolution = choose_resolution(first_date, last_date) if first_date else 'day'
+    if resolution == 'day':
+        for mood in analyze_moods(client_id):
+            if mood.roll_avg is not None:
+                roll_avg_dataset.append({'x': mood.date.isoformat(), 'y': mood.roll_avg})
+    else:
+        for rollup in get_mood_rollups(client_id, resolution, first_date, last_date):
+            if rollup.mean_mood is not None:
+                roll_avg_dataset.append({'x': rollup.period_start.isoformat(), 'y': rollup.mean_mood})
+
+    max_points = get_max_points()
+    if max_points:
+        picked = lttb_indices([point_ordinal(point['x']) for point in roll_avg_dataset],
+                              [point['y'] for point in roll_avg_dataset],
+                              max_points)
+        roll_avg_dataset = [roll_avg_dataset[i] for i in picked]
 
     datasets.append({'label': 'roll_avg',
                      'backgroundColor': 'rgba(0,0,0,0)',
@@ -420,17 +739,21 @@ def get_client_log_overview():
                      'pointBorderColor': 'rgba(0,0,0,0)',
                      'data': roll_avg_dataset})
 
-    return jsonify({'datasets': datasets, 'min_ate': datetime.strftime(client.days[0].date, '%Y-%m-%d')})
+    return jsonify({'datasets': datasets,
+                    'resolution': resolution,
+                    'min_ate': last_date.isoformat() if last_date else None})
 
 
 @app.route('/day_chart.json')
 # @login_required
+@conditional_on_data_version(lambda: session.get('user_id'))
 def get_day_logs():
     """ Get's all logs (events and day) for a specific day"""
 
     date_str = request.args.get('day')
     date = datetime.strptime(date_str, '%Y-%m-%d').date()
-    day = Day.query.filter_by(user_id=session['user_id'], date=date).first()
+    day = Day.query.options(db.joinedload('events'))\
+                   .filter_by(user_id=session['user_id'], date=date).first()
     datasets = []
 
     if day:
@@ -464,6 +787,235 @@ def get_day_logs():
 # HELPER FUNCTIONS
 
 
+def get_day_mood_chart(user_id, min_date, max_date):
+    """Gets columnar mood chart data of each day logged in a time window"""
+
+    chart = {'dates': [],
+             'overall_moods': [],
+             'roll_avg': [],
+             'roll_std': [],
+             'event_dates': [],
+             'event_moods': []}
+
+    # events of every day in the window, loaded together
+    events_by_day = get_events_by_day(user_id, min_date, max_date)
+    # only days in requested time window are read, as (day_id, date, overall_mood, roll stats) rows
+    for day in analyze_moods(user_id, min_date, max_date):
+        # only for days that have an overall mood
+        if day.overall_mood is not None:
+            # format date into moment.js format to be plottable on chart.js
+            date = day.date.isoformat()
+
+            chart['dates'].append(date)
+            chart['overall_moods'].append(day.overall_mood)
+            chart['roll_avg'].append(day.roll_avg)
+            chart['roll_std'].append(day.roll_std)
+
+            # also append events for logged (no dummy) days
+            for event_id, event_name, event_mood, event_notes in events_by_day.get(day.day_id, []):
+                if event_mood:
+                    chart['event_dates'].append(date)
+                    chart['event_moods'].append(event_mood)
+
+    return chart
+
+
+def get_rollup_mood_chart(user_id, period, min_date, max_date):
+    """Gets columnar mood chart data of weekly/monthly rollups in a time window
+
+    Each period is a point at its mean mood, rolling stats are the period's mean and std.
+    Events aren't charted at this resolution.
+    """
+
+    chart = {'dates': [],
+             'overall_moods': [],
+             'roll_avg': [],
+             'roll_std': [],
+             'event_dates': [],
+             'event_moods': []}
+
+    for rollup in get_mood_rollups(user_id, period, min_date, max_date):
+        if rollup.num_logs:
+            chart['dates'].append(rollup.period_start.isoformat())
+            chart['overall_moods'].append(rollup.mean_mood)
+            chart['roll_avg'].append(rollup.mean_mood)
+            chart['roll_std'].append(rollup.std_mood)
+
+    return chart
+
+
+def get_max_points():
+    """Gets max_points requested to decimate chart series to, None if not requested"""
+
+    max_points = request.args.get('max_points', type=int)
+    if max_points:
+        return max(max_points, MIN_CHART_POINTS)
+
+
+def point_ordinal(date_str):
+    """Gets day number of an ISO date, as x value to decimate chart series with"""
+
+    return datetime.strptime(date_str, '%Y-%m-%d').toordinal()
+
+
+def downsample_mood_chart(chart, max_points):
+    """Decimates columnar mood chart data in place with LTTB
+
+    Dates are picked to keep the shape of both daily moods and rolling average,
+    each getting half of max_points. Events are decimated on their own.
+    """
+
+    if len(chart['dates']) > max_points:
+        x = np.array([point_ordinal(date) for date in chart['dates']], dtype=float)
+        moods = np.array(chart['overall_moods'], dtype=float)
+        roll_avg = np.array(chart['roll_avg'], dtype=float)
+        has_roll = np.flatnonzero(~np.isnan(roll_avg))
+
+        picked = set(lttb_indices(x, moods, max_points // 2))
+        picked.update(has_roll[lttb_indices(x[has_roll], roll_avg[has_roll], max_points - max_points // 2)])
+        picked = sorted(picked)
+
+        for column in ('dates', 'overall_moods', 'roll_avg', 'roll_std'):
+            chart[column] = [chart[column][i] for i in picked]
+
+    if len(chart['event_dates']) > max_points:
+        picked = lttb_indices([point_ordinal(date) for date in chart['event_dates']],
+                              chart['event_moods'],
+                              max_points)
+        for column in ('event_dates', 'event_moods'):
+            chart[column] = [chart[column][i] for i in picked]
+
+
+def make_mood_chart_datasets(chart):
+    """Expands columnar mood chart data into a list of chart.js datasets"""
+
+    # a dataset for each day, so chart.js doesn't draw lines between days
+    datasets = [dict(MOOD_CHART_STYLES['day'],
+                     label='Day %s' % date,
+                     data=[{'x': date, 'y': mood}])
+                for date, mood in zip(chart['dates'], chart['overall_moods'])]
+
+    datasets.extend(dict(MOOD_CHART_STYLES['event'],
+                         label='event',
+                         data=[{'x': date, 'y': mood}])
+                    for date, mood in zip(chart['event_dates'], chart['event_moods']))
+
+    roll_avg_dataset = []
+    roll_std_dataset = []
+    for date, roll_avg, roll_std in zip(chart['dates'], chart['roll_avg'], chart['roll_std']):
+        if roll_avg is not None:
+            roll_avg_dataset.append({'x': date, 'y': roll_avg})
+            roll_std_dataset.append({'x': date, 'y': roll_std})
+
+    datasets.append(dict(MOOD_CHART_STYLES['roll'], label='roll-avg', data=roll_avg_dataset))
+    datasets.append(dict(MOOD_CHART_STYLES['roll'], label='roll-std', data=roll_std_dataset))
+
+    return datasets
+
+
+def read_import_rows():
+    """Gives rows of logs to import from a 'logs' file or the request body, as dicts
+
+    CSV is read row by row, JSON must be an array of objects.
+    """
+
+    upload = request.files.get('logs')
+    if upload:
+        stream = upload.stream
+        is_csv = upload.filename.lower().endswith('.csv')
+    else:
+        stream = request.stream
+        is_csv = request.mimetype == 'text/csv'
+
+    if is_csv:
+        return csv.DictReader(stream)
+
+    rows = json.load(stream)
+    if not isinstance(rows, list):
+        raise ValueError('Expected a JSON array of logs')
+
+    return rows
+
+
+def parse_import_row(row, row_num):
+    """Makes a DayLog or EventLog of a row to import, raises ValueError if it isn't valid"""
+
+    def get_date(key):
+        try:
+            return datetime.strptime(row[key], '%Y-%m-%d').date()
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Row %s: %s must be a date like 2016-08-09' % (row_num, key))
+
+    def get_mood(key, required=False):
+        value = row.get(key)
+        if value is None or value == '':
+            if required:
+                raise ValueError('Row %s: %s is required' % (row_num, key))
+            return None
+        try:
+            mood = int(value)
+        except (TypeError, ValueError):
+            mood = None
+        if mood is None or not -50 <= mood <= 50:
+            raise ValueError('Row %s: %s must be a number from -50 to 50' % (row_num, key))
+        return mood
+
+    if not isinstance(row, dict):
+        raise ValueError('Row %s: expected an object' % row_num)
+
+    date = get_date('date')
+    overall_mood = get_mood('overall_mood', required=True)
+    max_mood = get_mood('max_mood')
+    min_mood = get_mood('min_mood')
+    notes = row.get('notes') or None
+
+    if row.get('type', 'day') == 'event':
+        if not row.get('event_name'):
+            raise ValueError('Row %s: event_name is required' % row_num)
+        end_date = get_date('end_date') if row.get('end_date') else date
+        if end_date < date:
+            raise ValueError('Row %s: end_date is before date' % row_num)
+        if (end_date - date).days >= MAX_EVENT_DAYS:
+            raise ValueError('Row %s: events can last at most %s days' % (row_num, MAX_EVENT_DAYS))
+        return EventLog(row['event_name'][:64], date, end_date, overall_mood, max_mood, min_mood, notes)
+
+    return DayLog(date, overall_mood, max_mood, min_mood, notes)
+
+
+def unique_keys(mutations):
+    """Gives keys of mutations in order, without repeats"""
+
+    keys = []
+    seen = set()
+    for mutation in mutations:
+        if mutation['key'] not in seen:
+            seen.add(mutation['key'])
+            keys.append(mutation['key'])
+
+    return keys
+
+
+def make_sync_changes(days, events):
+    """Formats changed day logs and event logs (with their date range) for /sync.json"""
+
+    def date_str(date):
+        return date.isoformat() if date else None
+
+    return {'days': [{'date': date_str(day.date),
+                      'overall_mood': day.overall_mood,
+                      'max_mood': day.max_mood,
+                      'min_mood': day.min_mood,
+                      'notes': day.notes} for day in days],
+            'events': [{'event_id': event.event_id,
+                        'event_name': event.event_name,
+                        'date': date_str(event.start_date),
+                        'end_date': date_str(event.end_date),
+                        'overall_mood': event.overall_mood,
+                        'max_mood': event.max_mood,
+                        'min_mood': event.min_mood,
+                        'notes': event.notes} for event in events]}
+
+
 def get_mood_rating():
     """Gets ratings for a mood (day/event)"""
 
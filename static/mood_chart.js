@@ -53,19 +53,56 @@ function initializeOptions(minDate, maxDate) {
 ///////////           CREATE CHART FUNCTIONS           /////////////
 ////////////////////////////////////////////////////////////////////
 
+// EXPAND COLUMNAR MOOD CHART DATA INTO CHART.JS DATASETS
+// Server sends parallel arrays of dates/moods and each style once
+function expandMoodChartData(data) {
+    var datasets = [];
+    var i;
+
+    // a dataset for each day, so no lines are drawn between days
+    for (i=0; i<data.dates.length; i++) {
+        datasets.push($.extend({label: 'Day ' + data.dates[i],
+                                data: [{x: data.dates[i], y: data.overall_moods[i]}]},
+                               data.styles.day));
+    }
+
+    for (i=0; i<data.event_dates.length; i++) {
+        datasets.push($.extend({label: 'event',
+                                data: [{x: data.event_dates[i], y: data.event_moods[i]}]},
+                               data.styles.event));
+    }
+
+    var rollAvg = [];
+    var rollStd = [];
+    for (i=0; i<data.dates.length; i++) {
+        if (data.roll_avg[i] !== null) {
+            rollAvg.push({x: data.dates[i], y: data.roll_avg[i]});
+            rollStd.push({x: data.dates[i], y: data.roll_std[i]});
+        }
+    }
+    datasets.push($.extend({label: 'roll-avg', data: rollAvg}, data.styles.roll));
+    datasets.push($.extend({label: 'roll-std', data: rollStd}, data.styles.roll));
+
+    return datasets;
+}
+
+
 // CREATE A CHART OF MOOD LOGS OVER MULTIPLE DATES
 function createMoodChart(minDate, maxDate) {
     var options = initializeOptions(minDate, maxDate);
 
-    // AJAX get request for mood chart data
+    // AJAX get request for mood chart data, in compact columnar format
     $.get('/mood_chart.json',
         {minDate: minDate,
-         maxDate: maxDate},
+         maxDate: maxDate,
+         format: 'columnar',
+         // no more points than the chart has pixels across
+         max_points: ctx.canvas.width},
          function (data) {
             // Create a linechart with retrieved data
             moodChart = new Chart(ctx, {
                 type: 'line',
-                data: data,
+                data: {'datasets': expandMoodChartData(data)},
                 options: options
             });
             $('.mood-chart').css('visibility', 'visible');
@@ -78,9 +115,25 @@ function createMoodChart(minDate, maxDate) {
 function createClientChart(minDate, maxDate, clientId) {
     var options = initializeOptions(minDate, maxDate);
     $('.mood-chart').css('visibility', 'hidden');
+    // Use sparkline from client roster if it was loaded for the same window
+    if (clientRoster[clientId] && clientRosterMinDate <= minDate) {
+        moodChart = new Chart(ctx, {
+            type: 'line',
+            data: {'datasets': [{'label': 'roll_avg',
+                                 'backgroundColor': 'rgba(0,0,0,0)',
+                                 'borderColor': 'rgba(0,0,255,1)',
+                                 'pointBackgroundColor': 'rgba(0,0,0,0)',
+                                 'pointBorderColor': 'rgba(0,0,0,0)',
+                                 'data': clientRoster[clientId].sparkline}]},
+            options: options
+            });
+        $('.mood-chart').css('visibility', 'visible');
+        return;
+    }
     //AJAX get request for specfic client's 'smooth' mood data
     $.get('/client_log_overview.json',
-        {clientId: clientId},
+        {clientId: clientId,
+         max_points: ctx.canvas.width},
          function (data) {
             options.scales.xAxes[0].time.min = data['min_date'];
             moodChart = new Chart(ctx, {
@@ -94,6 +147,27 @@ function createClientChart(minDate, maxDate, clientId) {
 }
 
 
+// LOAD MOOD OVERVIEW OF ALL ACTIVE CLIENTS FOR PRO USER
+// Keeps each client's sparkline to chart without another request
+var clientRoster = {};
+var clientRosterMinDate;
+function loadClientRoster(minDate) {
+    $.get('/client_roster.json',
+        {minDate: minDate},
+         function (data) {
+            clientRosterMinDate = minDate;
+            for (var i=0; i<data.clients.length; i++) {
+                var client = data.clients[i];
+                clientRoster[client.user_id] = client;
+                if (client.lastlog_date) {
+                    $('#client-to-view option[value=' + client.user_id + ']')
+                        .text(client.username + ' (last log ' + client.lastlog_date + ')');
+                }
+            }
+        });
+}
+
+
 // CREATE CHART FOR SPECIFIC DAY
 function createDayChart(day) {
     $('#today-date-str').html(day);
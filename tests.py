@@ -1,9 +1,28 @@
 import unittest
-from server import app
+from server import app, chart_cache, identity_cache, invalidation_listener, size_chart_cache
 from flask import session
-from model import connect_to_db, db, example_data, User, Professional, Contract, Prescription, Drug, Day, Event
-from datetime import datetime
+from model import (connect_to_db, db, example_data, get_mood_rollups, User, Professional, Contract, Prescription, Drug,
+                   Day, Event, MoodRollup)
+from mood_analysis import analyze_moods, analyze_moods_pandas
+from datetime import datetime, date, timedelta
+from instrumentation import QueryBudgetExceeded
+from drug_ingest import ingest_drugs
+from cache import LRUCache
+from flask_mail import Message
+import asyncore
 import json
+import os
+import pstats
+import shutil
+import smtpd
+import sys
+import tempfile
+import threading
+
+# cron jobs are run from their own directory
+CRON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cron_code')
+
+MAIL_CONFIG = ['MAIL_SERVER', 'MAIL_PORT', 'MAIL_USE_TLS', 'MAIL_USERNAME', 'MAIL_PASSWORD', 'MAIL_SUPPRESS_SEND']
 
 
 class NotLoggedInFlaskTests(unittest.TestCase):
@@ -14,6 +33,8 @@ class NotLoggedInFlaskTests(unittest.TestCase):
 
         app.config['TESTING'] = True
         app.config['SECRET_KEY'] = 'abc'
+        # caches are only evicted by the test's own requests
+        app.config['INVALIDATION_LISTENER'] = False
         self.client = app.test_client()
 
         connect_to_db(app, 'testdb')
@@ -86,6 +107,8 @@ class BasicUserFlaskTests(unittest.TestCase):
 
         app.config['TESTING'] = True
         app.config['SECRET_KEY'] = 'abc'
+        # caches are only evicted by the test's own requests
+        app.config['INVALIDATION_LISTENER'] = False
         self.client = app.test_client()
 
         connect_to_db(app, 'testdb')
@@ -101,6 +124,8 @@ class BasicUserFlaskTests(unittest.TestCase):
 
         db.session.close()
         db.drop_all()
+        # data versions restart with the database
+        chart_cache.clear()
 
     def test_user_dashboard(self):
         """ Test user1 dashboard"""
@@ -164,6 +189,37 @@ class BasicUserFlaskTests(unittest.TestCase):
                  'events': []}
                 == test_day.get_info_dict()), 'Day did not have the right info'
 
+    def test_log_day_rollups(self):
+        """ Test logging days keeps user1's weekly and monthly rollups up to date"""
+
+        for log_date, mood in [('2016-11-01', 10), ('2016-11-02', 20)]:
+            self.client.post('/log_day_mood',
+                             data={'today-date': log_date,
+                                   'overall-mood': mood,
+                                   'notes': ''})
+
+        week = MoodRollup.query.filter_by(user_id=1, period='week', period_start=date(2016, 10, 31)).one()
+        month = MoodRollup.query.filter_by(user_id=1, period='month', period_start=date(2016, 11, 1)).one()
+        for rollup in [week, month]:
+            self.assertEqual(rollup.num_logs, 2)
+            self.assertAlmostEqual(rollup.mean_mood, 15)
+            self.assertEqual([rollup.min_mood, rollup.max_mood], [10, 20])
+
+        # multi-year window is charted by month
+        result = self.client.get('/mood_chart.json',
+                                 query_string={'minDate': '2012-01-01',
+                                               'maxDate': '2016-12-31',
+                                               'format': 'columnar'})
+        chart = json.loads(result.data)
+        self.assertEqual(chart['resolution'], 'month')
+        self.assertEqual(chart['dates'], ['2016-11-01'])
+        self.assertAlmostEqual(chart['overall_moods'][0], 15)
+
+        # weeks ending before the window aren't charted
+        self.client.post('/log_day_mood', data={'today-date': '2016-10-25', 'overall-mood': 0, 'notes': ''})
+        rollups = get_mood_rollups(1, 'week', date(2016, 11, 1), date(2016, 11, 30))
+        self.assertEqual([rollup.period_start for rollup in rollups], [date(2016, 10, 31)])
+
     def test_log_event(self):
         """ Test user1 logging a event"""
 
@@ -196,6 +252,110 @@ class BasicUserFlaskTests(unittest.TestCase):
         assert (['2016-11-01', 1, None]
                 == dummy_day_info), 'Dummy day did not have right info'
 
+    def test_log_event_range(self):
+        """ Test user1 logging an event lasting several days"""
+
+        result = self.client.post('/log_event_mood',
+                                  data={'event-name': 'Test trip',
+                                        'today-event-date': '2016-08-08',
+                                        'end-date': '2016-08-10',
+                                        'overall-mood': 20},
+                                  follow_redirects=True)
+        self.assertEqual(result.status_code, 200)
+
+        # Make sure event is associated with every day of its range, existing day is kept
+        test_event = Event.query.filter_by(event_name='Test trip').first()
+        assert test_event is not None, 'Event was not created'
+        event_days = [(datetime.strftime(day.date, '%Y-%m-%d'), day.overall_mood) for day in test_event.days]
+        self.assertEqual(event_days, [('2016-08-10', None), ('2016-08-09', 10), ('2016-08-08', None)])
+
+        # Ranges longer than a year aren't logged
+        result = self.client.post('/log_event_mood',
+                                  data={'event-name': 'Test century',
+                                        'today-event-date': '1900-01-01',
+                                        'end-date': '2100-01-01',
+                                        'overall-mood': 20},
+                                  follow_redirects=True)
+        self.assertIn('Events can last at most 366 days', result.data)
+        self.assertIsNone(Event.query.filter_by(event_name='Test century').first())
+
+    def test_import_logs(self):
+        """ Test user1 importing day and event logs as JSON and CSV"""
+
+        logs = [{'date': '2016-08-09', 'overall_mood': 30, 'notes': 'Imported'},
+                {'date': '2016-08-10', 'overall_mood': -5, 'min_mood': -20, 'max_mood': 5},
+                {'type': 'event', 'event_name': 'Imported event', 'date': '2016-08-10',
+                 'end_date': '2016-08-11', 'overall_mood': 25}]
+        result = self.client.post('/import_logs', data=json.dumps(logs), content_type='application/json')
+        self.assertEqual(json.loads(result.data), {'days': 2, 'events': 1})
+
+        # Existing day is replaced, event gets a dummy day
+        days = Day.query.filter_by(user_id=1).order_by(Day.date).all()
+        self.assertEqual([(datetime.strftime(day.date, '%Y-%m-%d'), day.overall_mood) for day in days],
+                         [('2016-08-09', 30), ('2016-08-10', -5), ('2016-08-11', None)])
+        self.assertEqual(len(Event.query.filter_by(event_name='Imported event').one().days), 2)
+
+        csv_logs = 'date,overall_mood,notes\n2016-08-12,12,From csv\n2016-08-12,14,Last one wins\n'
+        result = self.client.post('/import_logs', data=csv_logs, content_type='text/csv')
+        self.assertEqual(json.loads(result.data), {'days': 2, 'events': 0})
+        day = Day.query.filter_by(user_id=1, date='2016-08-12').one()
+        self.assertEqual((day.overall_mood, day.notes), (14, 'Last one wins'))
+
+        # A bad row imports nothing
+        logs = [{'date': '2016-09-01', 'overall_mood': 1},
+                {'date': '2016-09-02', 'overall_mood': 99}]
+        result = self.client.post('/import_logs', data=json.dumps(logs), content_type='application/json')
+        self.assertEqual(result.status_code, 400)
+        self.assertIn('Row 2', json.loads(result.data)['error'])
+        self.assertIsNone(Day.query.filter_by(user_id=1, date='2016-09-01').first())
+
+        logs = [{'type': 'event', 'event_name': 'Imported century', 'date': '1900-01-01',
+                 'end_date': '2100-01-01', 'overall_mood': 1}]
+        result = self.client.post('/import_logs', data=json.dumps(logs), content_type='application/json')
+        self.assertEqual(result.status_code, 400)
+        self.assertIn('at most 366 days', json.loads(result.data)['error'])
+
+    def test_sync_logs(self):
+        """ Test user1 syncing queued logs twice applies them once"""
+
+        payload = {'since': 0,
+                   'mutations': [{'key': 'a1', 'date': '2016-08-20', 'overall_mood': 7},
+                                 {'key': 'a2', 'type': 'event', 'event_name': 'Synced event',
+                                  'date': '2016-08-20', 'overall_mood': 9},
+                                 {'key': 'a3', 'date': '2016-08-21', 'overall_mood': 70}]}
+        result = json.loads(self.client.post('/sync.json', data=json.dumps(payload),
+                                             content_type='application/json').data)
+        self.assertEqual([item['status'] for item in result['results']], ['applied', 'applied', 'error'])
+        self.assertIn('2016-08-20', [day['date'] for day in result['changes']['days']])
+        self.assertIn('Synced event', [event['event_name'] for event in result['changes']['events']])
+
+        # Sending the same keys again changes nothing
+        payload['since'] = result['cursor']
+        retry = json.loads(self.client.post('/sync.json', data=json.dumps(payload),
+                                            content_type='application/json').data)
+        self.assertTrue(retry['results'][1]['duplicate'])
+        self.assertEqual(retry['results'][1]['event_id'], result['results'][1]['event_id'])
+        self.assertEqual(retry['changes'], {'days': [], 'events': []})
+        self.assertEqual(retry['cursor'], result['cursor'])
+        self.assertEqual(Event.query.filter_by(event_name='Synced event').count(), 1)
+
+    def test_export_logs(self):
+        """ Test user1 exporting their history, and not someone else's"""
+
+        result = self.client.get('/export_logs.csv')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.data.splitlines(),
+                         ['date,overall_mood,max_mood,min_mood,notes,events,prescriptions',
+                          '2016-08-09,10,,,,Test event 1,'])
+
+        result = self.client.get('/export_logs.ndjson')
+        day = json.loads(result.data.splitlines()[0])
+        self.assertEqual((day['date'], day['overall_mood']), ('2016-08-09', 10))
+        self.assertEqual([event['event_name'] for event in day['events']], ['Test event 1'])
+
+        result = self.client.get('/export_logs.csv', query_string={'clientId': 2})
+        self.assertEqual(result.status_code, 403)
+
     def test_log_html_json(self):
         """ Test getting user1's logs as html """
 
@@ -237,6 +397,255 @@ class BasicUserFlaskTests(unittest.TestCase):
         assert {'label': 'Day 2016-08-09',
                 'data': [{'x': '2016-08-09', 'y': 10}]} in datasets['datasets']
 
+    def test_mood_chart_not_modified(self):
+        """ Test mood chart is revalidated by ETag until user1 logs again """
+
+        chart_args = {'minDate': '2016-07-10', 'maxDate': '2016-08-20'}
+        result = self.client.get('/mood_chart.json', query_string=chart_args)
+        etag = result.headers['ETag']
+        self.assertEqual(result.headers['Cache-Control'], 'private, no-cache')
+
+        result = self.client.get('/mood_chart.json', query_string=chart_args, headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, '')
+
+        self.client.post('/log_day_mood', data={'today-date': '2016-08-10', 'overall-mood': 5, 'notes': ''})
+        result = self.client.get('/mood_chart.json', query_string=chart_args, headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+        # another chart of the same data version and arguments isn't the same response
+        chart_args['day'] = '2016-08-09'
+        mood_result = self.client.get('/mood_chart.json', query_string=chart_args)
+        day_result = self.client.get('/day_chart.json', query_string=chart_args)
+        self.assertNotEqual(mood_result.headers['ETag'], day_result.headers['ETag'])
+
+    def test_mood_chart_columnar_json(self):
+        """ Test getting user1's mood chart data in columnar format """
+
+        result = self.client.get('/mood_chart.json',
+                                 query_string={'minDate': '2016-07-10',
+                                               'maxDate': '2016-08-20',
+                                               'format': 'columnar'})
+        chart = json.loads(result.data)
+        self.assertEqual(chart['dates'], ['2016-08-09'])
+        self.assertEqual(chart['overall_moods'], [10])
+        self.assertEqual(chart['roll_avg'], [None])
+        self.assertEqual(chart['event_dates'], ['2016-08-09'])
+        self.assertEqual(chart['event_moods'], [15])
+        self.assertIn('day', chart['styles'])
+
+    def test_mood_chart_max_points(self):
+        """ Test user1's mood chart is decimated to max_points dates """
+
+        for i in range(1, 101):
+            db.session.add(Day(user_id=1, date=date(2016, 8, 9) - timedelta(days=i), overall_mood=i % 7))
+        db.session.commit()
+
+        result = self.client.get('/mood_chart.json',
+                                 query_string={'minDate': '2016-01-01',
+                                               'maxDate': '2016-08-20',
+                                               'format': 'columnar',
+                                               'max_points': 20})
+        chart = json.loads(result.data)
+        self.assertLessEqual(len(chart['dates']), 20)
+        # first and last days are always kept
+        self.assertEqual(chart['dates'][0], '2016-05-01')
+        self.assertEqual(chart['dates'][-1], '2016-08-09')
+
+    def test_profile_request(self):
+        """ Test admin can profile a request and see its hot functions """
+
+        # not an admin yet
+        result = self.client.get('/admin/profile.json')
+        self.assertEqual(result.status_code, 403)
+
+        app.config['ADMIN_USER_IDS'] = (1,)
+        try:
+            self.client.get('/mood_chart.json',
+                            query_string={'minDate': '2016-07-10',
+                                          'maxDate': '2016-08-20'},
+                            headers={'X-Profile': '1'})
+            result = self.client.get('/admin/profile.json',
+                                     query_string={'endpoint': 'get_mood_chart_data', 'limit': 100})
+        finally:
+            app.config['ADMIN_USER_IDS'] = ()
+
+        profile = json.loads(result.data)['get_mood_chart_data']
+        self.assertGreaterEqual(profile['requests'], 1)
+        self.assertTrue(any('analyze_moods' in function['function'] for function in profile['functions']))
+
+    def test_profile_dump(self):
+        """ Test profiles are written to PROFILE_DIR in the background """
+
+        profile_dir = tempfile.mkdtemp()
+        app.config.update(ADMIN_USER_IDS=(1,), PROFILE_DIR=profile_dir, PROFILE_DUMP_INTERVAL=0)
+        try:
+            self.client.get('/mood_chart.json',
+                            query_string={'minDate': '2016-07-10', 'maxDate': '2016-08-20'},
+                            headers={'X-Profile': '1'})
+            for writer in threading.enumerate():
+                if writer.name == 'profile-writer':
+                    writer.join(5)
+        finally:
+            app.config.update(ADMIN_USER_IDS=(), PROFILE_DIR=None, PROFILE_DUMP_INTERVAL=300)
+
+        stats = pstats.Stats(os.path.join(profile_dir, 'get_mood_chart_data.prof'))
+        self.assertTrue(any('analyze_moods' in function for filename, line, function in stats.stats))
+        shutil.rmtree(profile_dir)
+
+    def test_analyze_moods_parity(self):
+        """ Test rolling moods from PostgreSQL match pandas """
+
+        # Give user1 30 more days of logs before the example day, one without a mood
+        for i in range(1, 31):
+            day_date = date(2016, 8, 9) - timedelta(days=i)
+            overall_mood = None if i == 20 else (i * 7) % 23 - 11
+            db.session.add(Day(user_id=1, date=day_date, overall_mood=overall_mood))
+        db.session.commit()
+
+        windows = [(None, None),
+                   (date(2016, 7, 25), date(2016, 8, 9)),
+                   (date(2016, 8, 1), date(2016, 8, 5))]
+        for min_date, max_date in windows:
+            sql_moods = analyze_moods(1, min_date, max_date)
+            pandas_moods = analyze_moods_pandas(1, min_date, max_date)
+            self.assertEqual([mood[:3] for mood in sql_moods], [mood[:3] for mood in pandas_moods])
+            for sql_mood, pandas_mood in zip(sql_moods, pandas_moods):
+                for sql_stat, pandas_stat in zip(sql_mood[3:], pandas_mood[3:]):
+                    if pandas_stat is None:
+                        self.assertIsNone(sql_stat)
+                    else:
+                        self.assertAlmostEqual(sql_stat, pandas_stat)
+
+    def test_rolling_moods_trailing(self):
+        """ Test rolling moods of a day are of it and the 13 logs before it """
+
+        # Give user2 moods 0 to 14 from 2016-08-01
+        for i in range(15):
+            db.session.add(Day(user_id=2, date=date(2016, 8, 1) + timedelta(days=i), overall_mood=i))
+        db.session.commit()
+
+        for analyze in (analyze_moods, analyze_moods_pandas):
+            moods = analyze(2)
+            self.assertEqual([mood.roll_avg for mood in moods[:13]], [None] * 13)
+
+            # days before min_date still count towards its window
+            moods = analyze(2, date(2016, 8, 14))
+            self.assertEqual([mood.date for mood in moods], [date(2016, 8, 14), date(2016, 8, 15)])
+            self.assertAlmostEqual(moods[0].roll_avg, 6.5)
+            self.assertAlmostEqual(moods[1].roll_avg, 7.5)
+            self.assertAlmostEqual(moods[1].roll_std, 17.5 ** 0.5)
+
+    def test_log_queries_per_request(self):
+        """ Test chart and day log routes don't load events day by day """
+
+        # Give user1 a month of logs with an event on each day
+        for i in range(1, 31):
+            day = Day(user_id=1, date=date(2016, 8, 9) - timedelta(days=i), overall_mood=i)
+            test_event = Event(user_id=1, event_name='Event %s' % i, overall_mood=i)
+            db.session.add_all([day, test_event])
+            test_event.days.append(day)
+        db.session.commit()
+        db.session.remove()
+
+        # user load with their data version, days with rolling moods, events
+        result = self.client.get('/mood_chart.json',
+                                 query_string={'minDate': '2016-07-01',
+                                               'maxDate': '2016-08-20'})
+        self.assertLessEqual(int(result.headers['X-DB-Queries']), 3)
+
+        # user load, day joined with its events
+        result = self.client.get('/logs_html.json',
+                                 query_string={'searchDate': '2016-08-01'})
+        self.assertLessEqual(int(result.headers['X-DB-Queries']), 2)
+
+        # user load (for their data version), day joined with its events
+        result = self.client.get('/day_chart.json',
+                                 query_string={'day': '2016-08-01'})
+        self.assertLessEqual(int(result.headers['X-DB-Queries']), 2)
+
+    def test_identity_cache(self):
+        """ Test logged in user isn't loaded again while their identity is cached"""
+
+        app.config['IDENTITY_CACHE_TTL'] = 60
+        try:
+            query_string = {'searchDate': '2016-08-09'}
+            first = self.client.get('/logs_html.json', query_string=query_string)
+            second = self.client.get('/logs_html.json', query_string=query_string)
+            self.assertEqual(int(second.headers['X-DB-Queries']), int(first.headers['X-DB-Queries']) - 1)
+
+            result = self.client.get('/user_dashboard')
+            self.assertIn('Hi user1, How Are You Doing Today?', result.data)
+        finally:
+            app.config['IDENTITY_CACHE_TTL'] = 0
+            identity_cache.clear()
+
+    def test_chart_cache(self):
+        """ Test mood chart is served from cache until user1 logs again """
+
+        chart_args = {'minDate': '2016-08-01', 'maxDate': '2016-08-31'}
+        first = self.client.get('/mood_chart.json', query_string=chart_args)
+        second = self.client.get('/mood_chart.json', query_string=chart_args)
+        self.assertEqual(second.data, first.data)
+        self.assertLess(int(second.headers['X-DB-Queries']), int(first.headers['X-DB-Queries']))
+
+        self.client.post('/log_day_mood', data={'today-date': '2016-08-10', 'overall-mood': 5, 'notes': ''})
+        result = self.client.get('/mood_chart.json', query_string=chart_args)
+        self.assertIn('2016-08-10', result.data)
+
+        # least recently used charts are evicted past the memory cap
+        cache = LRUCache(max_bytes=10)
+        cache.set('a', '1234', tag=1)
+        cache.set('b', '1234', tag=2)
+        cache.get('a')
+        cache.set('c', '1234', tag=1)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ('1234', None, '1234'))
+        cache.delete_tag(1)
+        self.assertEqual((cache.get('a'), cache.size), (None, 0))
+
+        # the cap is read once the app is configured, not when server is imported
+        max_bytes = app.config['CHART_CACHE_MAX_BYTES']
+        try:
+            app.config['CHART_CACHE_MAX_BYTES'] = 10
+            size_chart_cache()
+            self.assertEqual(chart_cache.max_bytes, 10)
+        finally:
+            app.config['CHART_CACHE_MAX_BYTES'] = max_bytes
+            size_chart_cache()
+
+    def test_invalidation_messages(self):
+        """ Test messages of writes by other processes evict user1's cached charts """
+
+        self.client.get('/mood_chart.json', query_string={'minDate': '2016-08-01', 'maxDate': '2016-08-31'})
+        self.assertEqual(len(chart_cache.entries), 1)
+
+        invalidation_listener.dispatch('user', '2')
+        self.assertEqual(len(chart_cache.entries), 1)
+        invalidation_listener.dispatch('user', '1')
+        self.assertEqual(len(chart_cache.entries), 0)
+
+    def test_query_budget(self):
+        """ Test requests over their query budget fail """
+
+        app.config['SQL_QUERY_BUDGET'] = {'get_day_logs': 0}
+        try:
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get('/day_chart.json',
+                                query_string={'day': '2016-08-09'})
+        finally:
+            del app.config['SQL_QUERY_BUDGET']
+
+    def test_metrics(self):
+        """ Test request latencies are given at /metrics """
+
+        self.client.get('/mood_chart.json',
+                        query_string={'minDate': '2016-08-01', 'maxDate': '2016-08-31'})
+        result = self.client.get('/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('moodwatch_request_seconds_count{endpoint="get_mood_chart_data",status="200"}', result.data)
+        self.assertIn('moodwatch_db_pool_checkouts_total', result.data)
+
 
 class ProUserFlaskTests(unittest.TestCase):
     """Testing routes when user3 (professional) is logged in"""
@@ -246,6 +655,8 @@ class ProUserFlaskTests(unittest.TestCase):
 
         app.config['TESTING'] = True
         app.config['SECRET_KEY'] = 'abc'
+        # caches are only evicted by the test's own requests
+        app.config['INVALIDATION_LISTENER'] = False
         self.client = app.test_client()
 
         connect_to_db(app, 'testdb')
@@ -261,6 +672,8 @@ class ProUserFlaskTests(unittest.TestCase):
 
         db.session.close()
         db.drop_all()
+        # data versions restart with the database
+        chart_cache.clear()
 
     def test_pro_dashboard(self):
         """ Test professional dashboard """
@@ -272,6 +685,55 @@ class ProUserFlaskTests(unittest.TestCase):
         self.assertIn('<option value=\'1\'>user1', result.data)
         self.assertIn('<option value=\'2\'>user2', result.data)
 
+    def test_client_roster_json(self):
+        """ Test getting mood overview of all active clients of pro user3 """
+
+        # Give user1 two weeks of logs before the example day, all rated 10
+        for i in range(1, 15):
+            db.session.add(Day(user_id=1, date=date(2016, 8, 9) - timedelta(days=i), overall_mood=10))
+        db.session.commit()
+
+        result = self.client.get('/client_roster.json',
+                                 query_string={'minDate': '2016-08-01'})
+
+        clients = dict((client['username'], client) for client in json.loads(result.data)['clients'])
+        self.assertEqual(sorted(clients), ['user1', 'user2'])
+        self.assertEqual(clients['user1']['lastlog_date'], '2016-08-09')
+        self.assertAlmostEqual(clients['user1']['roll_avg'], 10)
+        self.assertAlmostEqual(clients['user1']['roll_std'], 0)
+        self.assertEqual([point['x'] for point in clients['user1']['sparkline']][-1], '2016-08-09')
+        self.assertEqual(clients['user2'], {'user_id': 2,
+                                            'username': 'user2',
+                                            'lastlog_date': None,
+                                            'roll_avg': None,
+                                            'roll_std': None,
+                                            'sparkline': []})
+
+    def test_export_client_logs(self):
+        """ Test pro user3 exporting history of client user2 with their prescription"""
+
+        db.session.add(Day(user_id=2, date=date(2016, 5, 1), overall_mood=-3))
+        db.session.commit()
+
+        result = self.client.get('/export_logs.ndjson', query_string={'clientId': 2})
+        self.assertEqual(result.status_code, 200)
+        day = json.loads(result.data.splitlines()[0])
+        self.assertEqual([prescription['drug'] for prescription in day['prescriptions']], ['Example drug'])
+
+    def test_active_prescriptions(self):
+        """ Test active prescriptions of user2 are read in one query, with earlier ones flagged"""
+
+        client = User.query.get(2)
+        db.session.add(Prescription(client_id=2, pro_id=3, drug_id=1, start_date='2016-01-01',
+                                    end_date='2016-03-01', instructions='Earlier prescription'))
+        db.session.commit()
+
+        active = client.get_active_prescriptions()
+        self.assertEqual(active.keys(), ['Example drug'])
+        self.assertEqual((active['Example drug']['pro'], active['Example drug']['start_date'],
+                          active['Example drug']['has_old']),
+                         ('user3', '2016-04-16', True))
+
     def test_drugs(self):
         """ Test drugs database """
 
@@ -282,6 +744,42 @@ class ProUserFlaskTests(unittest.TestCase):
         self.assertIn('Example drug brand', result.data)
         self.assertIn('Example drug uses', result.data)
 
+    def test_search_drugs(self):
+        """ Test drug typeahead by name prefix, brand and misspelled name """
+
+        result = json.loads(self.client.get('/drugs.json', query_string={'q': 'exam'}).data)
+        self.assertEqual(result['total'], 1)
+        self.assertEqual(result['drugs'][0]['generic_name'], 'Example drug')
+
+        # New drugs are found once committed
+        db.session.add(Drug(generic_name='Sertraline', brand_name='Zoloft', uses='Depression'))
+        db.session.commit()
+
+        result = json.loads(self.client.get('/drugs.json', query_string={'q': 'zol'}).data)
+        self.assertEqual([drug['generic_name'] for drug in result['drugs']], ['Sertraline'])
+        result = json.loads(self.client.get('/drugs.json', query_string={'q': 'setraline'}).data)
+        self.assertEqual([drug['generic_name'] for drug in result['drugs']], ['Sertraline'])
+
+        result = json.loads(self.client.get('/drugs.json', query_string={'limit': 1, 'offset': 1}).data)
+        self.assertEqual((result['total'], len(result['drugs'])), (2, 1))
+
+    def test_ingest_drugs(self):
+        """ Test refreshing drugs from a CSV file keeps existing drugs in place """
+
+        drug_file = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        drug_file.write('generic_name,brand_name,uses\n'
+                        'Example drug,Example drug brand,New uses\n'
+                        'Sertraline,Zoloft,Depression\n'
+                        'Sertraline,Lustral,Depression\n'
+                        ',No generic name,\n')
+        drug_file.close()
+        counts = ingest_drugs(drug_file.name)
+        os.remove(drug_file.name)
+
+        self.assertEqual((counts['read'], counts['inserted'], counts['updated'], counts['skipped']), (4, 1, 1, 1))
+        self.assertEqual(Drug.query.get(1).uses, 'New uses')
+        self.assertEqual(Drug.query.filter_by(generic_name='Sertraline').one().brand_name, 'Lustral')
+
     def test_add_prescription(self):
         """ Test adding a prescription for example drug """
 
@@ -342,5 +840,81 @@ class ProUserFlaskTests(unittest.TestCase):
                                                      'notes': 'Example prescription'}]}} == client_meds)
 
 
+class RefusingSMTPServer(smtpd.SMTPServer):
+    """Local stand-in SMTP server, refusing messages to addresses starting with 'bad'"""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if any(rcpt.startswith('bad') for rcpt in rcpttos):
+            return '550 No such user'
+        self.received.extend(rcpttos)
+
+
+class ReminderSenderTests(unittest.TestCase):
+    """Testing sending reminders to a local SMTP server"""
+
+    def setUp(self):
+        """ Stuff to do before every test."""
+
+        self.server = RefusingSMTPServer()
+        self.loop = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+        self.loop.daemon = True
+        self.loop.start()
+
+        # importing cron_mail sets the app's mail config, restored in tearDown
+        self.mail_state = app.extensions.get('mail')
+        self.mail_config = dict((key, app.config.get(key)) for key in MAIL_CONFIG)
+        sys.path.append(CRON_DIR)
+        from cron_mail import ReminderSender, mail
+        self.ReminderSender = ReminderSender
+
+        app.config.update(MAIL_SERVER='localhost',
+                          MAIL_PORT=self.server.socket.getsockname()[1],
+                          MAIL_USE_TLS=False,
+                          MAIL_USERNAME=None,
+                          MAIL_PASSWORD=None,
+                          MAIL_SUPPRESS_SEND=False)
+        mail.init_app(app)
+
+    def tearDown(self):
+        """ Do at end of every test. """
+
+        app.config.update(self.mail_config)
+        if self.mail_state is None:
+            app.extensions.pop('mail', None)
+        else:
+            app.extensions['mail'] = self.mail_state
+        sys.path.remove(CRON_DIR)
+        self.server.close()
+        self.loop.join(1)
+
+    def test_refused_reminder(self):
+        """ Test a refused address fails only its own reminder """
+
+        recipients = ['user1@email.com', 'bad@email.com', 'user2@email.com']
+        sender = self.ReminderSender(num_workers=1, retry_wait=0)
+        sender.send([Message('Reminder', sender='moodwatch@email.com', recipients=[recipient], body='Hi')
+                     for recipient in recipients])
+        sender.close()
+
+        self.assertEqual((sender.sent, sender.failed), (2, 1))
+        self.assertEqual(self.server.received, ['user1@email.com', 'user2@email.com'])
+
+    def test_failed_batch(self):
+        """ Test an unexpected error fails its batch and the worker sends the next one """
+
+        sender = self.ReminderSender(num_workers=1, retry_wait=0)
+        # flask_mail asserts a message has recipients
+        sender.send([Message('Reminder', sender='moodwatch@email.com', body='Hi')])
+        sender.send([Message('Reminder', sender='moodwatch@email.com', recipients=['user1@email.com'], body='Hi')])
+        sender.close()
+
+        self.assertEqual((sender.sent, sender.failed), (1, 1))
+        self.assertEqual(self.server.received, ['user1@email.com'])
+
+
 if __name__ == '__main__':
     unittest.main()